@@ -0,0 +1,587 @@
+"""
+Benchmarks for super_tool.py.
+
+This builds a synthetic registry shaped like the Bazel Central Registry, with boost.* modules,
+several 1.x.y version folders, source.json files, patches and source archives, and serves the
+archives from a local HTTP server. It then times setup, change detection, base commit discovery
+and patch generation end to end at each scale, and adds the results to a JSON file so slowdowns
+show up from one run to the next.
+
+    python benchmark.py
+    python benchmark.py --scales 8x200,64x2000 --repeat 3 --output results.json
+"""
+
+import os
+import sys
+import argparse
+import subprocess
+import threading
+import functools
+import contextlib
+import json
+import hashlib
+import base64
+import io
+import random
+import shutil
+import tarfile
+import tempfile
+import time
+import platform
+import statistics
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+
+import super_tool
+
+default_scales = "4x100,16x500,64x1000"
+default_output = "benchmark_results.json"
+
+# Upstream registry commits made before and after our branch, for base commit discovery
+upstream_history_commits = 500
+upstream_commits_after_branch = 20
+local_commits = 3
+
+git_identity = {
+    "GIT_AUTHOR_NAME": "Benchmark",
+    "GIT_AUTHOR_EMAIL": "benchmark@example.com",
+    "GIT_COMMITTER_NAME": "Benchmark",
+    "GIT_COMMITTER_EMAIL": "benchmark@example.com",
+}
+
+
+def main(argv):
+    args = get_argument_parser().parse_args(argv)
+
+    # Sources get git baselines, which need someone to commit as
+    for key, value in git_identity.items():
+        os.environ.setdefault(key, value)
+    super_tool.show_progress = False
+    super_tool.use_fast_baseline = args.fast_baseline
+    super_tool.download_backend = args.download_backend
+    if args.jobs:
+        super_tool.local_threads = super_tool.download_threads = args.jobs
+    super_tool.tracer.enable()
+
+    run = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "commit": get_tool_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "options": {
+            "versions": args.versions,
+            "file_size": args.file_size,
+            "changed": args.changed,
+            "repeat": args.repeat,
+            "jobs": args.jobs,
+            "fast_baseline": args.fast_baseline,
+            "download_backend": args.download_backend,
+        },
+        "scales": [],
+    }
+    for modules, files in args.scales:
+        samples = [run_scale(modules, files, args) for _ in range(args.repeat)]
+        scale = summarise_samples(modules, files, samples)
+        run["scales"].append(scale)
+        print_scale(scale, find_previous_scale(args.output, scale["name"]))
+
+    save_run(args.output, run)
+    print(f"Results added to {args.output}")
+    return 0
+
+
+def get_argument_parser():
+    parser = argparse.ArgumentParser(
+        prog="benchmark",
+        description="Time super_tool against synthetic registries of several sizes.",
+    )
+    parser.add_argument(
+        "--scales",
+        type=parse_scales,
+        default=parse_scales(default_scales),
+        metavar="MODULESxFILES[,...]",
+        help=f"the registries to build, as module count x files per archive (default {default_scales})",
+    )
+    parser.add_argument(
+        "--versions",
+        type=int,
+        default=3,
+        help="version folders per module, only the newest is set up (default 3)",
+    )
+    parser.add_argument(
+        "--file-size",
+        type=int,
+        default=4096,
+        help="bytes per file in the archives (default 4096)",
+    )
+    parser.add_argument(
+        "--changed",
+        type=float,
+        default=0.25,
+        help="fraction of modules to edit before detecting changes and patching (default 0.25)",
+    )
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        default=1,
+        help="build and time each scale this many times, keeping the fastest (default 1)",
+    )
+    parser.add_argument(
+        "-j", "--jobs", type=int, help="how many things super_tool does at once"
+    )
+    parser.add_argument(
+        "--fast-baseline",
+        action="store_true",
+        help="build git baselines straight from the archives",
+    )
+    parser.add_argument(
+        "--download-backend",
+        choices=["threads", "asyncio"],
+        default=super_tool.download_backend,
+        help=f"how super_tool downloads archives (default {super_tool.download_backend})",
+    )
+    parser.add_argument(
+        "--output",
+        default=default_output,
+        help=f"the JSON file to add the results to (default {default_output})",
+    )
+    parser.add_argument(
+        "--keep",
+        action="store_true",
+        help="keep the synthetic registries, and print where they are",
+    )
+    return parser
+
+
+def parse_scales(value):
+    try:
+        return [
+            tuple(int(number) for number in scale.lower().split("x"))
+            for scale in value.split(",")
+            if scale
+        ]
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Expected MODULESxFILES[,...], got {value}")
+
+
+def run_scale(modules, files, args):
+    """Build a registry at one scale, then time each command against it"""
+    root = tempfile.mkdtemp(prefix=f"super_tool_benchmark_{modules}x{files}_")
+    server = None
+    try:
+        archives_dir = os.path.join(root, "archives")
+        registry_dir = os.path.join(root, "registry")
+        server = serve_directory(archives_dir)
+
+        start = time.perf_counter()
+        archive_bytes = make_registry(
+            registry_dir,
+            archives_dir,
+            f"http://127.0.0.1:{server.server_address[1]}",
+            modules,
+            files,
+            args.versions,
+            args.file_size,
+        )
+        expected_base_commit = make_history(registry_dir)
+        generate_seconds = time.perf_counter() - start
+
+        # Start with nothing cached, so setup downloads everything
+        super_tool.archive_cache_dir = os.path.join(root, "archive_cache")
+        registry_index = super_tool.RegistryIndex(os.path.join(registry_dir, "modules"))
+        registry_state = super_tool.RegistryState(registry_dir)
+        phases = {}
+
+        with timed_phase(phases, "setup"):
+            _, failures = super_tool.setup_sources(
+                registry_dir, registry_index, registry_state
+            )
+        if failures:
+            raise RuntimeError(f"Setup failed: {failures[0]}")
+
+        with timed_phase(phases, "setup_again"):
+            super_tool.setup_sources(registry_dir, registry_index, registry_state)
+
+        # Freshly set up sources differ from their baselines by their patches, so patch them all
+        # first, as a new maintainer would
+        with timed_phase(phases, "patch_all"):
+            results = super_tool.patch_and_hash(
+                registry_dir,
+                registry_index.source_dirs(),
+                registry_state,
+                registry_index,
+            )
+        check_results(results)
+
+        changed_sources = edit_sources(registry_index, args.changed)
+        with timed_phase(phases, "detect"):
+            detected = super_tool.detect_changed_sources(registry_index.source_dirs())
+        if sorted(detected) != sorted(changed_sources):
+            raise RuntimeError(
+                f"Detected {len(detected)} changed sources, expected {len(changed_sources)}"
+            )
+
+        with timed_phase(phases, "base_commit"):
+            base_commit = super_tool.get_base_commit(registry_dir, interactive=False)
+        if base_commit != expected_base_commit:
+            raise RuntimeError(
+                f"Found base commit {base_commit}, expected {expected_base_commit}"
+            )
+
+        with timed_phase(phases, "patch"):
+            results = super_tool.patch_and_hash(
+                registry_dir, detected, registry_state, registry_index
+            )
+        check_results(results)
+
+        return {
+            "generate_seconds": generate_seconds,
+            "archive_bytes": archive_bytes,
+            "changed_modules": len(changed_sources),
+            "phases": phases,
+        }
+
+    finally:
+        if server:
+            server.shutdown()
+            server.server_close()
+        if args.keep:
+            print(f"Kept {root}")
+        else:
+            shutil.rmtree(root, ignore_errors=True)
+
+
+def check_results(results):
+    errors = [result.error for result in results if result.error]
+    if errors:
+        raise RuntimeError(f"Patching failed: {errors[0]}")
+
+
+@contextlib.contextmanager
+def timed_phase(phases, name):
+    """Time the code inside the with block, and total up the super_tool phases traced inside it"""
+    with super_tool.tracer.lock:
+        first_event = len(super_tool.tracer.events)
+    start = time.perf_counter()
+    yield
+    seconds = time.perf_counter() - start
+    with super_tool.tracer.lock:
+        events = super_tool.tracer.events[first_event:]
+
+    breakdown = {}
+    for event in events:
+        totals = breakdown.setdefault(
+            event["name"], {"calls": 0, "seconds": 0, "subprocesses": 0}
+        )
+        totals["calls"] += 1
+        totals["seconds"] += event["dur"] / 1e6
+        totals["subprocesses"] += event["args"]["subprocesses"]
+
+    phases[name] = {
+        "seconds": seconds,
+        "downloaded_bytes": sum(
+            event["args"]["bytes"] for event in events if event["name"] == "Downloading"
+        ),
+        "peak_rss": super_tool.get_peak_rss().get("peak_rss"),
+        "breakdown": breakdown,
+    }
+
+
+def make_registry(
+    registry_dir, archives_dir, base_url, modules, files, versions, file_size
+):
+    """
+    Write a registry with the given number of modules, each with version folders 1.80.0 onwards.
+    Only the newest version of each module gets an archive, as it's the only one set up. Each
+    module depends on up to two of the modules before it.
+
+    :return: The total size of the archives, in bytes.
+    """
+    os.makedirs(archives_dir)
+    generator = random.Random(0)  # The same registry every run, so runs compare
+    version_names = [f"1.{80 + index}.0" for index in range(versions)]
+    names = [f"lib{index}" for index in range(modules)]
+    archive_bytes = 0
+
+    for index, name in enumerate(names):
+        dependencies = generator.sample(names[:index], min(index, 2))
+        module_dir = os.path.join(registry_dir, "modules", f"boost.{name}")
+        os.makedirs(module_dir)
+        write_json(
+            os.path.join(module_dir, "metadata.json"),
+            {
+                "homepage": "http://boost.org",
+                "maintainers": [],
+                "repository": [f"github:boostorg/{name}"],
+                "versions": version_names,
+                "yanked_versions": {},
+            },
+        )
+
+        for version in version_names:
+            version_dir = os.path.join(module_dir, version)
+            os.makedirs(os.path.join(version_dir, "patches"))
+            strip_prefix = f"{name}-boost-{version}"
+            archive_name = f"{strip_prefix}.tar.gz"
+            module_bazel = make_module_bazel(name, version, dependencies)
+
+            if version == version_names[-1]:
+                archive = make_archive(
+                    strip_prefix, name, dependencies, files, file_size, generator
+                )
+                with open(os.path.join(archives_dir, archive_name), "wb") as f:
+                    f.write(archive)
+                archive_bytes += len(archive)
+                integrity = make_sri(archive)
+            else:
+                integrity = make_sri(archive_name.encode())  # Never downloaded
+
+            patch = make_patch(name, module_bazel, dependencies).encode()
+            with open(os.path.join(version_dir, "patches", "patch.diff"), "wb") as f:
+                f.write(patch)
+            with open(os.path.join(version_dir, "MODULE.bazel"), "w") as f:
+                f.write(module_bazel)
+            with open(os.path.join(version_dir, "presubmit.yml"), "w") as f:
+                f.write("matrix:\n  platform:\n  - ubuntu2004\n")
+            write_json(
+                os.path.join(version_dir, super_tool.module_source_file_name),
+                {
+                    "integrity": integrity,
+                    "strip_prefix": strip_prefix,
+                    "url": f"{base_url}/{archive_name}",
+                    "patch_strip": 1,
+                    "patches": {"patch.diff": make_sri(patch)},
+                },
+            )
+
+    return archive_bytes
+
+
+def make_archive(strip_prefix, name, dependencies, files, file_size, generator):
+    """Make a gzipped tarball laid out like a Boost library, with files of roughly file_size bytes"""
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w:gz", compresslevel=6) as tar:
+
+        def add_file(path, content):
+            data = content.encode()
+            info = tarfile.TarInfo(f"{strip_prefix}/{path}")
+            info.size = len(data)
+            info.mode = 0o644
+            tar.addfile(info, io.BytesIO(data))
+
+        includes = "".join(
+            f"#include <boost/{dependency}.hpp>\n" for dependency in dependencies
+        )
+        add_file(f"include/boost/{name}.hpp", f"{includes}#pragma once\n")
+        add_file(".gitignore", "*.o\n")
+
+        # Hex text compresses about as well as real source code does
+        for index in range(max(files - 2, 0)):
+            folder = ("include/boost/" + name + "/detail", "src", "test")[index % 3]
+            add_file(
+                f"{folder}/file{index}.hpp",
+                f"#include <boost/{name}.hpp>\n"
+                + generator.randbytes(file_size // 2).hex()
+                + "\n",
+            )
+
+    return buffer.getvalue()
+
+
+def make_module_bazel(name, version, dependencies):
+    return (
+        f'module(\n    name = "boost.{name}",\n    version = "{version}",\n'
+        f'    bazel_compatibility = [">=7.0.0"],\n    compatibility_level = 108300,\n)\n\n'
+        'bazel_dep(name = "boost.rules.tools", version = "1.0.0")\n'
+        + "".join(
+            f'bazel_dep(name = "boost.{dependency}", version = "{version}")\n'
+            for dependency in dependencies
+        )
+    )
+
+
+def make_patch(name, module_bazel, dependencies):
+    """Make a patch adding the BUILD.bazel and MODULE.bazel files, as Boost module patches do"""
+    build = (
+        'load("@boost.rules.tools//:tools.bzl", "boost_library")\n\n'
+        f'boost_library(\n    name = "{name}",\n    deps = [\n'
+        + "".join(f'        "@boost.{dependency}",\n' for dependency in dependencies)
+        + "    ],\n)\n"
+    )
+    return "".join(
+        make_new_file_diff(path, content)
+        for path, content in (("BUILD.bazel", build), ("MODULE.bazel", module_bazel))
+    )
+
+
+def make_new_file_diff(path, content):
+    lines = content.splitlines(keepends=True)
+    return (
+        f"diff --git a/{path} b/{path}\nnew file mode 100644\n--- /dev/null\n+++ b/{path}\n"
+        f"@@ -0,0 +1,{len(lines)} @@\n" + "".join("+" + line for line in lines)
+    )
+
+
+def make_sri(data):
+    return "sha256-" + base64.b64encode(hashlib.sha256(data).digest()).decode()
+
+
+def write_json(path, data):
+    with open(path, "w") as f:
+        json.dump(data, f, indent=4)
+
+
+def make_history(registry_dir):
+    """
+    Commit the registry, give it a long upstream history and a local branch with a few commits,
+    like a fork of the Bazel Central Registry. The registry is its own "upstream" remote, so
+    fetching from it works offline.
+
+    :return: The upstream commit the local branch was based on.
+    """
+    git(registry_dir, "init", "-q", "-b", "main")
+    git(registry_dir, "add", ".")
+    git(registry_dir, "commit", "-q", "--no-gpg-sign", "-m", "Add Boost modules")
+    add_empty_commits(registry_dir, "main", upstream_history_commits, "Upstream")
+    base_commit = git(registry_dir, "rev-parse", "main").strip()
+
+    git(registry_dir, "checkout", "-q", "-b", "local")
+    add_empty_commits(registry_dir, "local", local_commits, "Local")
+    add_empty_commits(
+        registry_dir, "main", upstream_commits_after_branch, "Later upstream"
+    )
+    git(registry_dir, "remote", "add", "upstream", ".")
+    return base_commit
+
+
+def add_empty_commits(repo_dir, branch, count, message):
+    """Add commits to a branch with a single git fast-import, rather than a git commit each"""
+    lines = []
+    for index in range(count):
+        lines += [
+            f"commit refs/heads/{branch}",
+            f"committer Benchmark <benchmark@example.com> {1700000000 + index} +0000",
+            f"data <<EOF\n{message} commit {index}\nEOF",
+        ]
+        if index == 0:
+            lines.append(f"from refs/heads/{branch}^0")
+        lines.append("")
+    subprocess.run(
+        ["git", "fast-import", "--quiet"],
+        cwd=repo_dir,
+        input="\n".join(lines).encode(),
+        check=True,
+    )
+
+
+def git(repo_dir, *args):
+    return subprocess.run(
+        ["git", *args],
+        cwd=repo_dir,
+        stdout=subprocess.PIPE,
+        check=True,
+        text=True,
+    ).stdout
+
+
+def edit_sources(registry_index, fraction):
+    """Edit a header and add a file in a fraction of the module sources, returning those sources"""
+    sources = registry_index.source_dirs()
+    changed_sources = sources[: max(1, round(len(sources) * fraction))]
+    for source in changed_sources:
+        module = registry_index.module_of(source)
+        name = module.split(".", 1)[1]
+        with open(os.path.join(source, "include", "boost", f"{name}.hpp"), "a") as f:
+            f.write("// Edited\n")
+        with open(os.path.join(source, "include", "boost", "added.hpp"), "w") as f:
+            f.write("#pragma once\n")
+    return changed_sources
+
+
+def serve_directory(directory):
+    """Serve a folder over HTTP on a free local port, in a background thread"""
+
+    class QuietHandler(SimpleHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(
+        ("127.0.0.1", 0), functools.partial(QuietHandler, directory=directory)
+    )
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def summarise_samples(modules, files, samples):
+    """Keep the fastest of each phase, as the others were slowed by something else on the machine"""
+    phases = {}
+    for name in samples[0]["phases"]:
+        fastest = min(samples, key=lambda sample: sample["phases"][name]["seconds"])
+        phases[name] = {
+            **fastest["phases"][name],
+            "samples": [sample["phases"][name]["seconds"] for sample in samples],
+        }
+    return {
+        "name": f"{modules}x{files}",
+        "modules": modules,
+        "files": files,
+        "archive_bytes": samples[0]["archive_bytes"],
+        "changed_modules": samples[0]["changed_modules"],
+        "generate_seconds": statistics.median(
+            sample["generate_seconds"] for sample in samples
+        ),
+        "phases": phases,
+    }
+
+
+def print_scale(scale, previous_scale=None):
+    print(
+        f"{scale['name']}: {scale['modules']} modules, {scale['files']} files each, "
+        f"{scale['archive_bytes'] / 1024**2:.1f} MiB of archives "
+        f"(generated in {scale['generate_seconds']:.1f}s)"
+    )
+    for name, phase in scale["phases"].items():
+        line = f"  {name:<12}{phase['seconds']:>9.3f}s"
+        previous_phase = (previous_scale or {}).get("phases", {}).get(name)
+        if previous_phase and previous_phase["seconds"]:
+            change = phase["seconds"] / previous_phase["seconds"] - 1
+            line += f"{change:>+9.0%} since last run"
+        print(line)
+
+
+def load_runs(path):
+    try:
+        with open(path) as f:
+            return json.load(f)["runs"]
+    except FileNotFoundError:
+        return []
+
+
+def find_previous_scale(path, name):
+    """Find the latest result for a scale with the same name, to compare against"""
+    for run in reversed(load_runs(path)):
+        for scale in run["scales"]:
+            if scale["name"] == name:
+                return scale
+    return None
+
+
+def save_run(path, run):
+    super_tool.write_json_atomically(path, {"runs": load_runs(path) + [run]})
+
+
+def get_tool_commit():
+    """The commit of super_tool.py being benchmarked, marked if it has uncommitted changes"""
+    tool_dir = os.path.dirname(os.path.abspath(super_tool.__file__))
+    try:
+        commit = git(tool_dir, "rev-parse", "HEAD").strip()
+        if git(tool_dir, "status", "--porcelain", "--", "super_tool.py"):
+            commit += "-dirty"
+        return commit
+    except (subprocess.CalledProcessError, OSError):
+        return None
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
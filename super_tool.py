@@ -1,35 +1,368 @@
 import os
 import sys
+import argparse
 import subprocess
 import threading
-from queue import Queue
+from queue import Queue, Empty
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from collections import namedtuple
 import json
+import functools
+import contextlib
+import mmap
+import array
+import re
 import shutil
-import requests
-import tarfile
+import stat
+import hashlib
+import base64
 import logging
 import time
-from prompt_toolkit.formatted_text import HTML
-from prompt_toolkit.styles import Style
-from prompt_toolkit.shortcuts import (
-    radiolist_dialog,
-    checkboxlist_dialog,
-    input_dialog,
-    message_dialog,
-    button_dialog,
-    ProgressBar,
-)
+import urllib.parse
+import select
+import errno
+import struct
+import importlib.util
+
+# requests, tarfile, ctypes, prompt_toolkit and ProcessPoolExecutor (which brings in
+# multiprocessing) are slow to import, so they're imported by the functions that need them. That
+# way the menu and batch commands start quickly
 
 module_source_file_name = "source.json"
 
+# Downloader settings, shared by every download worker
+download_chunk_size = 1024 * 1024  # Bytes written to disk per chunk
+download_timeout = (10, 60)  # Seconds to (connect, wait between bytes)
+download_max_retries = 4
+download_retry_backoff = 1.0  # Seconds before the first retry, doubled on each retry
+download_per_host_limit = 6  # Concurrent transfers allowed to a single host
+
+# "threads" downloads with requests, one transfer per download thread. "asyncio" downloads on a
+# single event loop with httpx (pip install httpx, and h2 for HTTP/2), keeping up to
+# async_download_limit transfers in flight and multiplexing them over HTTP/2 where it can
+download_backend = os.environ.get("SUPER_TOOL_DOWNLOAD_BACKEND", "threads")
+async_download_limit = int(os.environ.get("SUPER_TOOL_ASYNC_DOWNLOADS", 32))
+
+# Archive cache, shared between every registry checkout of this user and keyed by integrity hash
+archive_cache_dir = os.environ.get(
+    "SUPER_TOOL_CACHE_DIR",
+    os.path.join(
+        os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")),
+        "boost.rules.tools",
+        "archives",
+    ),
+)
+archive_cache_max_bytes = int(
+    os.environ.get("SUPER_TOOL_CACHE_MAX_BYTES", 5 * 1024**3)
+)  # Least recently used archives are evicted beyond this size
+offline_mode = os.environ.get("SUPER_TOOL_OFFLINE", "0") != "0"
+
+# Worker pool sizes. Network-bound work gets plenty of threads, disk and CPU-bound work one per core
+download_threads = int(os.environ.get("SUPER_TOOL_DOWNLOAD_THREADS", 8))
+local_threads = int(os.environ.get("SUPER_TOOL_THREADS", os.cpu_count() or 4))
+
+# Let git's fsmonitor daemon tell git status which files changed, rather than it checking them all
+use_git_fsmonitor = os.environ.get("SUPER_TOOL_FSMONITOR", "0") != "0"
+
+# Where patch verification extracts archives, memory backed (tmpfs) where there is one
+verify_scratch_dir = os.environ.get(
+    "SUPER_TOOL_SCRATCH_DIR", "/dev/shm" if os.path.isdir("/dev/shm") else None
+)
+
+# Show progress bars while working. Batch commands turn them off when the output isn't a terminal
+show_progress = True
+progress_refresh_interval = (
+    0.5  # Seconds between progress label updates when nothing finishes
+)
+
+# Build each module's baseline commit straight from its archive with git fast-import
+use_fast_baseline = os.environ.get("SUPER_TOOL_FAST_BASELINE", "0") != "0"
+
+# Watch mode waits for a source to go quiet for watch_debounce seconds before patching it, and
+# checks file stats every watch_poll_interval seconds where inotify isn't available
+watch_debounce = 0.3
+watch_poll_interval = 0.5
+
+# Files are scanned for includes in batches of this size, spread across a process per core
+include_scan_batch_size = 256
+
+# Write a Chrome trace of where the time went to this file, and print a summary at the end
+trace_file = os.environ.get("SUPER_TOOL_TRACE")
+
+
+class Tracer:
+    """
+    Records each phase of work per module: its wall time, the bytes it downloaded, the subprocesses
+    it started and the peak memory use so far. Work handed to a thread pool through propagate also
+    counts towards the phases in progress where it was handed over. The result can be exported as
+    Chrome trace events,
+    for chrome://tracing or https://ui.perfetto.dev, or summarised as a table. Nothing is recorded
+    until it's enabled.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.events = []
+        self.thread_names = {}
+        self.start = time.perf_counter()
+
+    def enable(self):
+        if self.enabled:
+            return
+        self.enabled = True
+        self.start = time.perf_counter()
+        sys.addaudithook(self.audit)  # Hooks can't be removed, so only add it once
+
+    def active_spans(self):
+        return self.local.__dict__.setdefault("spans", [])
+
+    def audit(self, event, args):
+        # Every subprocess, whether from run, check_output or Popen, starts with this event
+        if event == "subprocess.Popen":
+            with self.lock:  # Phases can be shared with other threads through propagate
+                for span in self.active_spans():
+                    span["subprocesses"] += 1
+
+    def propagate(self, func):
+        """
+        Wrap a function to be run on another thread, so the subprocesses it starts and bytes it
+        transfers count towards the phases in progress on this one too.
+        """
+        if not self.enabled:
+            return func
+        parent_spans = list(self.active_spans())
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            spans = self.active_spans()
+            depth = len(spans)
+            spans.extend(parent_spans)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                del spans[depth:]
+
+        return wrapper
+
+    @contextlib.contextmanager
+    def span(self, name, module=None):
+        """Record the code inside the with block as a phase"""
+        if not self.enabled:
+            yield
+            return
+
+        span = {"module": module, "bytes": 0, "subprocesses": 0}
+        self.active_spans().append(span)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            self.active_spans().pop()
+            thread = threading.current_thread()
+            with self.lock:
+                self.thread_names[thread.ident] = thread.name
+                self.events.append(
+                    {
+                        "name": name,
+                        "cat": "super_tool",
+                        "ph": "X",
+                        "ts": (start - self.start) * 1e6,
+                        "dur": (end - start) * 1e6,
+                        "pid": os.getpid(),
+                        "tid": thread.ident,
+                        "args": {**span, **get_peak_rss()},
+                    }
+                )
+
+    def add_bytes(self, count):
+        """Count bytes transferred against every phase in progress on this thread"""
+        with self.lock:
+            for span in self.active_spans():
+                span["bytes"] += count
+
+    def counted(self, chunks):
+        """Pass chunks through unchanged, counting their bytes as transferred"""
+        for chunk in chunks:
+            self.add_bytes(len(chunk))
+            yield chunk
+
+    def export(self, path):
+        """Write everything recorded as a Chrome trace event file"""
+        with self.lock:
+            events = list(self.events)
+            events += [
+                {
+                    "name": "thread_name",
+                    "ph": "M",
+                    "pid": os.getpid(),
+                    "tid": ident,
+                    "args": {"name": name},
+                }
+                for ident, name in self.thread_names.items()
+            ]
+        write_json_atomically(path, {"traceEvents": events, "displayTimeUnit": "ms"})
+
+    def summary(self):
+        """Total up each phase into a table"""
+        phases = {}
+        with self.lock:
+            for event in self.events:
+                phase = phases.setdefault(
+                    event["name"],
+                    {"calls": 0, "total": 0, "max": 0, "bytes": 0, "subprocesses": 0},
+                )
+                seconds = event["dur"] / 1e6
+                phase["calls"] += 1
+                phase["total"] += seconds
+                phase["max"] = max(phase["max"], seconds)
+                phase["bytes"] += event["args"]["bytes"]
+                phase["subprocesses"] += event["args"]["subprocesses"]
+
+        lines = [
+            f"{'Phase':<24}{'Calls':>7}{'Total s':>10}{'Mean s':>9}{'Max s':>9}{'MiB':>9}{'Procs':>7}"
+        ]
+        for name, phase in sorted(phases.items(), key=lambda item: -item[1]["total"]):
+            lines.append(
+                f"{name:<24}{phase['calls']:>7}{phase['total']:>10.2f}"
+                f"{phase['total'] / phase['calls']:>9.3f}{phase['max']:>9.3f}"
+                f"{phase['bytes'] / 1024**2:>9.1f}{phase['subprocesses']:>7}"
+            )
+        peak_rss = get_peak_rss()
+        if peak_rss:
+            lines.append(
+                f"Peak RSS: {peak_rss['peak_rss'] / 1024**2:.0f} MiB for super_tool, "
+                f"{peak_rss['peak_child_rss'] / 1024**2:.0f} MiB for the largest subprocess"
+            )
+        return "\n".join(lines)
+
+
+tracer = Tracer()
+
+
+def traced(name):
+    """Record every call of the decorated function as a phase, against the module of its first argument"""
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not tracer.enabled:
+                return func(*args, **kwargs)
+            module = (
+                get_module_name(args[0]) if args and isinstance(args[0], str) else None
+            )
+            with tracer.span(name, module):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def get_module_name(path):
+    """Get the name of the Boost module a path is in, or None"""
+    return next(
+        (part for part in reversed(path.split(os.sep)) if part.startswith("boost.")),
+        None,
+    )
+
+
+def get_peak_rss():
+    """Get the peak memory use of this process and of its largest subprocess, in bytes, where known"""
+    try:
+        import resource
+    except ImportError:
+        return {}  # Windows
+
+    scale = (
+        1 if sys.platform == "darwin" else 1024
+    )  # ru_maxrss is bytes on macOS, KiB elsewhere
+    return {
+        "peak_rss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale,
+        "peak_child_rss": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+        * scale,
+    }
+
+
+def get_setup_stages(registry_state, fast_baseline=False):
+    """
+    Get the run_pipeline stages that set up a module version folder's source.
+
+    Every stage records its result in registry_state and is skipped if its result is already
+    recorded, so an interrupted setup picks up from the last stage each module completed.
+    """
+
+    download_workers = get_download_workers()
+    start_bytes = downloaded_bytes.total
+
+    def describe_download():
+        return f"{(downloaded_bytes.total - start_bytes) / 1024**2:.1f} MiB"
+
+    def download(version):
+        if registry_state.get(version).get("archive"):
+            return True
+        if not fetch_source(version, stream_extract=not fast_baseline):
+            url = load_source_json(version).get("url")
+            raise RuntimeError(f"Couldn't download {url}")
+        integrity = load_source_json(version).get("integrity", "unknown")
+        registry_state.update(version, archive=integrity)
+
+    def extract(version):
+        if registry_state.get(version).get("extracted"):
+            return True
+        extract_source(version)
+        registry_state.update(version, extracted=True)
+
+    def initialize(version):
+        if registry_state.get(version).get("baseline"):
+            return True
+        boost_source = get_source_dir(version)
+        created = create_baseline(boost_source, fast_baseline)
+        if not os.path.isdir(os.path.join(boost_source, ".git")):
+            raise RuntimeError(f"Couldn't create a git baseline in {boost_source}")
+
+        registry_state.update(
+            version,
+            baseline=get_head_commit(boost_source),
+            source_dir=os.path.relpath(boost_source, os.path.dirname(version)),
+        )
+        if not created:
+            # Set up by an earlier run, which applied the patch too
+            registry_state.update(version, patched=True)
+            return False
+
+    def patch(version):
+        if registry_state.get(version).get("patched"):
+            return True
+        if not apply_source_patch(get_source_dir(version), version):
+            raise RuntimeError(f"Couldn't apply {version}/patches/patch.diff")
+        registry_state.update(version, patched=True)
+
+    stages = [
+        ("Downloading", download, download_workers, describe_download),
+        ("Extracting", extract, local_threads),
+        ("Initializing", initialize, local_threads),
+        ("Patching", patch, local_threads),
+    ]
+
+    # Fast baselines extract the archive themselves
+    if fast_baseline:
+        stages.pop(1)
+
+    return stages
+
 
 def main(registry_dir):
+    from prompt_toolkit.formatted_text import HTML
+    from prompt_toolkit.shortcuts import input_dialog, radiolist_dialog, yes_no_dialog
+
     # Important Variables
     last_command_status = None
     modules_dir = os.path.join(registry_dir, "modules")
-    boost_lib_dirs = find_boost_lib_dirs(modules_dir)
-    boost_lib_newest_version_dirs = find_boost_lib_newest_dirs(boost_lib_dirs)
-    boost_source_dirs = find_boost_source_dirs(boost_lib_newest_version_dirs)
+    registry_index = RegistryIndex(modules_dir)
+    registry_state = RegistryState(registry_dir)
 
     # Setup logging
     logger = logging.getLogger("boost")  # Create a named logger
@@ -58,8 +391,10 @@ def main(registry_dir):
             values=[
                 ("setup_registry", "Set up your Registry for Boost Module Maintenance"),
                 ("patch_generator", "Generate Patches from Changes"),
+                ("watch", "Watch for Changes and Generate Patches as You Edit"),
                 ("moduleBump", "Version Bump a Module"),
                 ("boostBump", "Bump Boost Version (All Modules)"),
+                ("verify", "Verify Patches Apply to Their Archives"),
                 ("clean", "Restore Clean Registry State (Not required to git commit)"),
             ],
             ok_text="Confirm",
@@ -68,578 +403,4096 @@ def main(registry_dir):
         ).run()
 
         if menu_selection == "setup_registry":
-            # Download all sources
-            print("Downloading sources...")
-            run_multithreaded_tasks(
-                boost_lib_newest_version_dirs,
-                download_source,
-                num_threads=8,
-                task_name="Downloading",
-            )
-
-            # Initialise git repos in each source so we can track changes
-            print("Initializing source folders...")
-            run_multithreaded_tasks(
-                boost_source_dirs,
-                initialize_repo,
-                8,
-                "Initializing",
-                boost_lib_newest_version_dirs,
-            )
-
-            # Set the local git exclude file so that all diffed_sources folders are ignored
-            print("Setting git exclude file...")
-            set_git_exclude(registry_dir)
-
-            last_command_status = "Registry initialization Success"
+            print("Setting up sources...")
+            _, failures = setup_sources(registry_dir, registry_index, registry_state)
+
+            if failures:
+                last_command_status = f"Registry initialization failed for {len(failures)} modules, see the log for details"
+            else:
+                last_command_status = "Registry initialization Success"
             print("Registry initialization complete!")
 
         elif menu_selection == "patch_generator":
             # Get the base commit to track changes from
             print("Getting base commit...")
             base_git_commit_hash = get_base_commit(registry_dir)
+            if not base_git_commit_hash:
+                last_command_status = "No base commit found or entered"
+                continue
 
             # Detect changed sources since commit
             print("Detecting changed sources...")
-            updated_sources = detect_changed_sources(boost_source_dirs)
+            updated_sources = detect_changed_sources(registry_index.source_dirs())
 
             # Bump modules needing version bump (also patches them)
             print("Checking for modules needing bumping...")
-            bumped_modules = bump_modules(
-                registry_dir, base_git_commit_hash, updated_sources
-            )
+            try:
+                bumped_modules = bump_modules(
+                    registry_dir,
+                    base_git_commit_hash,
+                    updated_sources,
+                    registry_index,
+                    registry_state,
+                )
+            except BumpError as e:
+                last_command_status = f"Bump failed, nothing was changed: {e}"
+                continue
 
             # Remove bumped sources as they get patched in bumping
-            for module in bumped_modules:
-                updated_sources.remove(module)
+            updated_sources = [
+                source for source in updated_sources if source not in bumped_modules
+            ]
 
             # Patch modules needing patches
+            results = []
             if updated_sources:
                 print("Patching modules...")
-                patch_and_hash(registry_dir, updated_sources)
+                results = patch_and_hash(
+                    registry_dir, updated_sources, registry_state, registry_index
+                )
 
-            last_command_status = "Patching Complete"
+            if any(result.error for result in results):
+                last_command_status = (
+                    "Patching failed for some modules, see the log for details"
+                )
+            else:
+                last_command_status = "Patching Complete"
+
+        elif menu_selection == "watch":
+            print("Watching sources for changes, press Ctrl-C to stop...")
+            patched = watch_sources(
+                registry_dir,
+                registry_index.source_dirs(),
+                registry_state,
+                registry_index,
+            )
+            last_command_status = f"Watch stopped after {patched} patches"
 
         elif menu_selection == "moduleBump":
-            last_command_status = "Module bumping isn't implemented yet. Sorry!"
+            module_names = input_dialog(
+                title="Version Bump a Module",
+                text="Which modules would you like to bump? Enter their names space separated, "
+                "e.g. boost.asio boost.beast. Modules depending on them are bumped too. "
+                "Modules already on an unreleased version are skipped.",
+                style=get_custom_style(),
+            ).run()
+            if not module_names:
+                continue
+            modules = module_names.split()
+            unknown_modules = [
+                module for module in modules if module not in registry_index
+            ]
+            if unknown_modules:
+                last_command_status = f"Unknown modules: {', '.join(unknown_modules)}"
+                continue
+
+            # Only released versions need bumping, which means knowing what was released
+            print("Getting base commit...")
+            base_git_commit_hash = get_base_commit(registry_dir)
+            if not base_git_commit_hash:
+                last_command_status = "No base commit found or entered"
+                continue
+
+            dependency_graph = DependencyGraph(registry_dir, registry_index)
+            awaiting_bump, transitive_bumps = find_modules_to_bump(
+                registry_dir,
+                base_git_commit_hash,
+                modules,
+                registry_index,
+                dependency_graph,
+            )
+            skipped = sorted(set(modules) - set(awaiting_bump))
+            if skipped:
+                print(f"Already on an unreleased version: {', '.join(skipped)}")
+            modules = awaiting_bump + transitive_bumps
+            if not modules:
+                last_command_status = (
+                    "Nothing to bump, every module is already on an unreleased version"
+                )
+                continue
+
+            print(f"Bumping {', '.join(modules)}...")
+            try:
+                results = bump_and_patch(
+                    registry_dir,
+                    modules,
+                    registry_index,
+                    registry_state,
+                    dependency_graph,
+                )
+            except BumpError as e:
+                last_command_status = f"Bump failed, nothing was changed: {e}"
+                continue
+            if any(result.error for result in results):
+                last_command_status = "Bumped, but patching failed for some modules, see the log for details"
+            else:
+                last_command_status = f"Bumped {len(modules)} modules"
+            if skipped:
+                last_command_status += f", skipped {len(skipped)} already unreleased"
 
         elif menu_selection == "boostBump":
-            last_command_status = "Boost version bumping isn't implemented yet. Sorry!"
+            boost_version = input_dialog(
+                title="Bump Boost Version",
+                text="Which Boost version would you like to bump every module to? e.g. 1.86.0",
+                style=get_custom_style(),
+            ).run()
+            if not boost_version:
+                continue
+
+            print(f"Bumping to Boost {boost_version}...")
+            try:
+                modules, failures, test_diffs = bump_boost(
+                    registry_dir, registry_index, registry_state, boost_version
+                )
+            except (BumpError, ValueError) as e:
+                last_command_status = f"Bump failed, nothing was changed: {e}"
+                continue
+            print(format_test_diff(test_diffs))
+            if failures:
+                last_command_status = f"Bumped {len(modules)} modules, but {len(failures)} failed to set up or patch, see the log for details"
+            else:
+                last_command_status = f"Bumped {len(modules)} modules to Boost {boost_version}, see above for their test changes"
+
+        elif menu_selection == "verify":
+            print("Verifying patches...")
+            results = verify_patches(registry_index)
+            print(format_verify_report(results))
+            failed = [result for result in results if result.problems]
+            if failed:
+                last_command_status = f"Verification failed for {len(failed)} of {len(results)} modules, see above for details"
+            else:
+                last_command_status = f"All {len(results)} modules verified"
 
         elif menu_selection == "clean":
+            print("Checking for changes that haven't been patched...")
+            unpatched_modules = find_unpatched_sources(
+                registry_index, registry_index.names()
+            )
+            if (
+                unpatched_modules
+                and not yes_no_dialog(
+                    title="Unpatched Changes",
+                    text="These modules have changes that aren't in their patches yet, which will be "
+                    f"lost:\n\n{', '.join(unpatched_modules)}\n\nDelete them anyway?",
+                    style=get_custom_style(),
+                ).run()
+            ):
+                last_command_status = (
+                    "Clean cancelled, generate patches first to keep your changes"
+                )
+                continue
+
             print("Deleting files...")
-            tidy_up(boost_lib_dirs)
-            last_command_status = "Clean Complete"
+            tidy_up(registry_index.lib_dirs(), registry_state, wait=False)
+            last_command_status = (
+                "Clean Complete, the old sources are being deleted in the background"
+            )
 
         else:
             break
 
 
-def download_source(boost_lib_newest_version):
-    lib = os.path.dirname(boost_lib_newest_version)
-    diffed_sources_dir = os.path.join(lib, "diffed_sources")
-    tar_path = os.path.join(diffed_sources_dir, "downloaded.tar.gz")
-    source_path = None
+def setup_sources(
+    registry_dir, registry_index, registry_state, modules=None, release_archive=None
+):
+    """
+    Take every module through download, extraction, git baseline and patching, then make git ignore
+    the sources. Each module moves on as soon as it's ready rather than waiting for the others.
+    Modules already set up from unchanged inputs are skipped entirely.
+
+    :param modules: The names of the modules to set up. Defaults to all of them.
+    :param release_archive: Optional path or url of a Boost release archive to take the sources
+        from, see extract_release_archive. Modules it doesn't cover are downloaded as usual.
+    :return: (version folders set up, failures), with failures as from run_pipeline.
+    """
+    pending_version_dirs = [
+        version
+        for version in registry_index.newest_version_dirs(modules)
+        if not registry_state.is_set_up(version)
+    ]
+    failures = []
+    if release_archive and pending_version_dirs:
+        extract_release_archive(release_archive, pending_version_dirs, registry_state)
+    if pending_version_dirs:
+        failures = run_pipeline(
+            pending_version_dirs,
+            get_setup_stages(registry_state, use_fast_baseline),
+            "Setting up sources",
+        )
 
-    # Create "diffed_sources" folder if it doesn't exist
-    if not os.path.exists(diffed_sources_dir):
-        os.makedirs(diffed_sources_dir)
+    # Set the local git exclude file so that all diffed_sources folders are ignored
+    set_git_exclude(registry_dir)
+
+    return pending_version_dirs, failures
 
-    # Get some details from sourceck.json
-    with open(
-        os.path.join(boost_lib_newest_version, module_source_file_name), "r"
-    ) as source_json_file:
-        file = json.load(source_json_file)
 
-        # Assume the source path based on the stripped prefix
-        source_path = os.path.join(diffed_sources_dir, file.get("strip_prefix", ""))
+def run_command(registry_dir, args):
+    """
+    Run a single command from the command line without any dialogs, e.g. in CI.
 
-        # Download the archive if needed
-        if not os.path.exists(tar_path):
-            url = file.get("url")
-            response = requests.get(url)
-            with open(tar_path, "wb") as f:
-                f.write(response.content)
+    :param registry_dir: The registry to work on.
+    :param args: The parsed arguments, see get_argument_parser.
+    :return: The exit code, which is 1 if anything failed.
+    """
+    global local_threads, download_threads, show_progress
+    if args.jobs:
+        local_threads = download_threads = args.jobs
+    if args.json or not sys.stdout.isatty():
+        show_progress = False
+    logging.basicConfig(level=logging.INFO)
+
+    registry_index = RegistryIndex(os.path.join(registry_dir, "modules"))
+    registry_state = RegistryState(registry_dir)
+    modules = args.modules or registry_index.names()
+    unknown_modules = [module for module in modules if module not in registry_index]
+    if unknown_modules:
+        logging.error(f"Unknown modules: {', '.join(unknown_modules)}")
+        return 1
+
+    def module_sources():
+        return [
+            registry_index[module].source_dir
+            for module in modules
+            if registry_index[module].source_dir
+        ]
 
-    # Extract the folder if it hasn't yet been extracted
-    if source_path and not os.path.exists(source_path):
-        with tarfile.open(tar_path, "r:gz") as tar:
-            tar.extractall(path=diffed_sources_dir)
+    def describe_failures(results):
+        return [
+            {
+                "module": registry_index.module_of(result.item),
+                "error": str(result.error),
+            }
+            for result in results
+            if result.error
+        ]
 
+    result = {"command": args.command}
+    if args.command == "setup":
+        version_dirs, failures = setup_sources(
+            registry_dir, registry_index, registry_state, modules, args.release_archive
+        )
+        failed = {version: (stage, error) for version, stage, error in failures}
+        result["set_up"] = [
+            registry_index.module_of(version)
+            for version in version_dirs
+            if version not in failed
+        ]
+        result["failed"] = [
+            {
+                "module": registry_index.module_of(version),
+                "stage": stage,
+                "error": str(error),
+            }
+            for version, (stage, error) in failed.items()
+        ]
 
-def initialize_repo(boost_source, boost_libs_newest_dirs):
-    # Check if the .git directory exists
-    if not os.path.exists(os.path.join(boost_source, ".git")):
+    elif args.command == "detect":
+        result["changed"] = [
+            registry_index.module_of(source)
+            for source in detect_changed_sources(module_sources())
+        ]
+
+    elif args.command == "patch":
+        # Named modules are patched whether or not they've changed
+        sources = (
+            module_sources()
+            if args.modules
+            else detect_changed_sources(module_sources())
+        )
+        results = patch_and_hash(registry_dir, sources, registry_state, registry_index)
+        result["patched"] = [
+            registry_index.module_of(result.item)
+            for result in results
+            if not result.error
+        ]
+        result["failed"] = describe_failures(results)
+
+    elif args.command == "bump":
+        base_git_commit_hash = args.base_commit or get_base_commit(
+            registry_dir, interactive=False
+        )
+        if not base_git_commit_hash:
+            logging.error("No base commit found, please pass one with --base-commit")
+            return 1
+        dependency_graph = DependencyGraph(registry_dir, registry_index)
+        awaiting_bump, transitive_bumps = find_modules_to_bump(
+            registry_dir,
+            base_git_commit_hash,
+            [
+                registry_index.module_of(source)
+                for source in detect_changed_sources(module_sources())
+            ],
+            registry_index,
+            dependency_graph,
+        )
         try:
-            # Initialize the git repository, suppressing stdout and capturing stderr
-            result = subprocess.run(
-                ["git", "init", "-b", "main"],
-                cwd=boost_source,
-                stdout=subprocess.DEVNULL,
-                stderr=subprocess.PIPE,
+            results = bump_and_patch(
+                registry_dir,
+                awaiting_bump + transitive_bumps,
+                registry_index,
+                registry_state,
+                dependency_graph,
             )
-            if result.stderr:
-                logging.error(
-                    f"Error initializing repository: {result.stderr.decode()}"
-                )
+        except BumpError as e:
+            logging.error(f"Bump failed, nothing was changed: {e}")
+            return 1
+        result["base_commit"] = base_git_commit_hash
+        result["bumped"] = [
+            registry_index.module_of(result.item)
+            for result in results
+            if not result.error
+        ]
+        result["transitive"] = transitive_bumps
+        result["failed"] = describe_failures(results)
 
-            # Add all files to the staging area
-            result = subprocess.run(
-                ["git", "add", "."],
-                cwd=boost_source,
-                stdout=subprocess.DEVNULL,
-                stderr=subprocess.DEVNULL,  # Suppress some annoying "CRLF will be replaced by LF" warnings
+    elif args.command == "boost-bump":
+        try:
+            bumped, failures, test_diffs = bump_boost(
+                registry_dir, registry_index, registry_state, args.version, args.modules
             )
-            if result.stderr:
-                logging.error(f"Error adding files: {result.stderr.decode()}")
+        except (BumpError, ValueError) as e:
+            logging.error(f"Bump failed, nothing was changed: {e}")
+            return 1
+        result["bumped"] = bumped
+        result["failed"] = failures
+        result["test_changes"] = test_diffs
+        if not args.json:
+            print(f"Bumped: {', '.join(bumped) or 'None'}")
+            for failure in failures:
+                print(f"Failed: {failure['module']}: {failure['error']}")
+            print(format_test_diff(test_diffs))
+            return 1 if failures else 0
+
+    elif args.command == "verify":
+        results = verify_patches(registry_index, modules)
+        result["verified"] = [
+            result.module for result in results if not result.problems
+        ]
+        result["failed"] = [result._asdict() for result in results if result.problems]
+        if not args.json:
+            print(format_verify_report(results))
+            return 1 if result["failed"] else 0
+
+    elif args.command == "test-diff":
+        diffs, failures = diff_test_files(
+            registry_index, modules, args.old_version, args.new_version
+        )
+        result["modules"] = diffs
+        result["failed"] = [
+            {"module": module, "error": error} for module, error in failures.items()
+        ]
+        if not args.json:
+            print(format_test_diff(diffs))
+            return 1 if failures else 0
 
-            # Commit the changes
-            result = subprocess.run(
+    elif args.command == "clean":
+        unpatched_modules = find_unpatched_sources(registry_index, modules)
+        if unpatched_modules and not args.force:
+            logging.error(
+                f"Changes in {', '.join(unpatched_modules)} aren't in their patches yet. "
+                "Patch them first, or pass --force to lose them"
+            )
+            result["unpatched"] = unpatched_modules
+            result["failed"] = unpatched_modules
+        else:
+            result["cleaned"] = modules
+            result["freed_bytes"] = tidy_up(
                 [
-                    "git",
-                    "commit",
-                    "--no-gpg-sign",
-                    "-m",
-                    "Initial commit",
-                ],  # GPG has resource contention with multithreading and isn't needed here anyway
-                cwd=boost_source,
-                stdout=subprocess.DEVNULL,
-                stderr=subprocess.PIPE,
+                    os.path.join(registry_index.modules_dir, module)
+                    for module in modules
+                ],
+                registry_state,
             )
-            if result.stderr:
-                logging.error(f"Error committing files: {result.stderr.decode()}")
 
-            # Construct the patch file path
-            patches_path = os.path.join(
-                find_matching_path(
-                    boost_libs_newest_dirs,
-                    os.path.basename(os.path.dirname(os.path.dirname(boost_source)))
-                    + os.path.sep,  # Adding the trailing separator makes sure we don't match only the start of a segment of path
-                ),
-                "patches",
-                "patch.diff",
+    if args.json:
+        print(json.dumps(result, indent=2))
+    else:
+        for key, value in result.items():
+            if key != "command":
+                if isinstance(value, list):
+                    value = ", ".join(
+                        item if isinstance(item, str) else json.dumps(item)
+                        for item in value
+                    )
+                print(f"{key.replace('_', ' ').capitalize()}: {value or 'None'}")
+
+    return 1 if result.get("failed") else 0
+
+
+def get_argument_parser(registry_argument=True):
+    """
+    Build the command line parser. The registry folder is the first argument, unless we're run
+    with bazel run, which gives it to us.
+    """
+    parser = argparse.ArgumentParser(
+        prog="super_tool",
+        description="Maintain the Boost modules in a Bazel registry. Without a command, an "
+        "interactive menu is shown.",
+    )
+    if registry_argument:
+        parser.add_argument("registry", help="your bazel-central-registry folder")
+    parser.add_argument(
+        "--trace",
+        metavar="FILE",
+        default=trace_file,
+        help="write a Chrome trace of where the time went to FILE, and print a summary at the end",
+    )
+
+    options = argparse.ArgumentParser(add_help=False)
+    options.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        help="how many things to do at once, defaults to one per core",
+    )
+    options.add_argument(
+        "-m",
+        "--modules",
+        type=lambda value: [module for module in value.split(",") if module],
+        action="extend",
+        metavar="MODULE[,MODULE...]",
+        help="only work on these modules, e.g. boost.asio,boost.beast",
+    )
+    options.add_argument(
+        "--json", action="store_true", help="print the results as JSON"
+    )
+
+    commands = parser.add_subparsers(dest="command", metavar="command")
+    setup = commands.add_parser(
+        "setup", parents=[options], help="download and set up module sources"
+    )
+    setup.add_argument(
+        "--release-archive",
+        metavar="PATH_OR_URL",
+        help="take the sources from one Boost release archive, e.g. boost_1_86_0.tar.gz, rather "
+        "than downloading each module's archive",
+    )
+    commands.add_parser(
+        "detect",
+        parents=[options],
+        help="list modules with changes that haven't been patched",
+    )
+    commands.add_parser(
+        "patch",
+        parents=[options],
+        help="generate patches for changed modules, or for every module named with --modules",
+    )
+    bump = commands.add_parser(
+        "bump",
+        parents=[options],
+        help="bump and patch changed modules that were already released, and their dependents",
+    )
+    bump.add_argument(
+        "--base-commit",
+        help="the registry commit to compare against, defaults to where you branched from upstream",
+    )
+    boost_bump = commands.add_parser(
+        "boost-bump",
+        parents=[options],
+        help="bump every module to a new Boost release, set them up, update their dependencies "
+        "and patch them",
+    )
+    boost_bump.add_argument("version", help="the Boost version to bump to, e.g. 1.86.0")
+    commands.add_parser(
+        "verify",
+        parents=[options],
+        help="check that every patch applies to its archive and matches source.json",
+    )
+    test_diff = commands.add_parser(
+        "test-diff",
+        parents=[options],
+        help="list the test files added, deleted and changed between two versions of each module",
+    )
+    test_diff.add_argument(
+        "--old-version",
+        help="the version to compare from, defaults to each module's second newest",
+    )
+    test_diff.add_argument(
+        "--new-version",
+        help="the version to compare to, defaults to each module's newest",
+    )
+    clean = commands.add_parser(
+        "clean", parents=[options], help="delete module sources"
+    )
+    clean.add_argument(
+        "--force",
+        action="store_true",
+        help="delete sources even if they have changes that aren't in their patches",
+    )
+    return parser
+
+
+def cli(argv):
+    """Show the menu, or run the command given. Returns the exit code"""
+    workspace_dir = os.environ.get("BUILD_WORKSPACE_DIRECTORY")
+    args = get_argument_parser(workspace_dir is None).parse_args(argv)
+    # Absolute, as most of the work runs git and other tools from inside the registry
+    registry_dir = os.path.abspath(
+        workspace_dir if workspace_dir is not None else args.registry
+    )
+
+    if args.trace:
+        tracer.enable()
+    try:
+        if args.command is None:
+            main(registry_dir)
+            return 0
+        return run_command(registry_dir, args)
+    finally:
+        if args.trace:
+            tracer.export(args.trace)
+            print(tracer.summary(), file=sys.stderr)
+
+
+@traced("Downloading")
+def fetch_source(boost_lib_newest_version, stream_extract=False):
+    """
+    Make sure a module's source archive is in its "diffed_sources" folder.
+
+    Archives are taken from the shared archive cache when possible, and anything downloaded is
+    checked against the integrity in source.json before it is used or cached.
+
+    :param boost_lib_newest_version: The module version folder to get the archive of.
+    :param stream_extract: If the archive has to be downloaded and the source isn't extracted
+        yet, extract it while it downloads.
+    :return: True if the archive is in place, False otherwise.
+    """
+    diffed_sources_dir = get_diffed_sources_dir(boost_lib_newest_version)
+    tar_path = os.path.join(diffed_sources_dir, "downloaded.tar.gz")
+    extract_dir = os.path.join(diffed_sources_dir, ".extracting")
+
+    # Create "diffed_sources" folder if it doesn't exist
+    if not os.path.exists(diffed_sources_dir):
+        os.makedirs(diffed_sources_dir)
+
+    # Get some details from source.json
+    file = load_source_json(boost_lib_newest_version)
+    url = file.get("url")
+    integrity = file.get("integrity")
+    strip_prefix = file.get("strip_prefix", "")
+    source_path = os.path.join(diffed_sources_dir, strip_prefix)
+
+    # Only reuse an archive from a previous run if it is the one source.json asks for
+    if os.path.exists(tar_path) and not archive_matches(tar_path, integrity):
+        logging.warning(f"{tar_path} doesn't match {integrity}, fetching it again")
+        os.remove(tar_path)
+
+    # Get the archive from the cache, or download it (extracting on the way through if asked to)
+    if not os.path.exists(tar_path) and not link_cached_archive(integrity, tar_path):
+        if offline_mode:
+            logging.error(f"Offline and {url} isn't in the archive cache")
+            return False
+
+        # The async downloader hands over whole archives, to be extracted once they're complete
+        stream_consumer = None
+        if (
+            stream_extract
+            and not get_async_downloader()
+            and not os.path.exists(source_path)
+        ):
+            stream_consumer = lambda stream: extract_archive(
+                stream, "r|gz", extract_dir
             )
 
-            result = subprocess.run(
-                ["git", "apply", "--whitespace=nowarn", patches_path],
-                cwd=boost_source,
-                stdout=subprocess.DEVNULL,
-                stderr=subprocess.PIPE,
+        if not download(url, tar_path, integrity, stream_consumer):
+            if os.path.exists(extract_dir):
+                shutil.rmtree(extract_dir)
+            return False
+
+        if stream_consumer:
+            finish_extract(diffed_sources_dir, strip_prefix)
+
+    add_to_archive_cache(tar_path, integrity)
+    return True
+
+
+@traced("Extracting")
+def extract_source(boost_lib_newest_version):
+    """Extract a module's downloaded archive, unless its source has already been extracted"""
+    diffed_sources_dir = get_diffed_sources_dir(boost_lib_newest_version)
+    strip_prefix = load_source_json(boost_lib_newest_version).get("strip_prefix", "")
+
+    if not os.path.exists(os.path.join(diffed_sources_dir, strip_prefix)):
+        tar_path = os.path.join(diffed_sources_dir, "downloaded.tar.gz")
+        with open(tar_path, "rb") as tar_file:
+            extract_archive(
+                tar_file, "r:gz", os.path.join(diffed_sources_dir, ".extracting")
             )
-            if result.stderr:
-                logging.error(f"Error applying patches: {result.stderr.decode()}")
+        finish_extract(diffed_sources_dir, strip_prefix)
 
-        except subprocess.CalledProcessError as e:
-            logging.error(f"An error occurred: {e}")
+    return True
 
 
-def set_git_exclude(registry_dir):
-    git_info_dir = os.path.join(registry_dir, ".git", "info")
-    exclude_file_path = os.path.join(git_info_dir, "exclude")
-    exclude_pattern = "diffed_sources/"
+def finish_extract(diffed_sources_dir, strip_prefix):
+    """
+    Move an extracted source into place. This only happens once it is complete, so an
+    interrupted extraction is never mistaken for a finished one.
+    """
+    extract_dir = os.path.join(diffed_sources_dir, ".extracting")
+    os.replace(
+        os.path.join(extract_dir, strip_prefix),
+        os.path.join(diffed_sources_dir, strip_prefix),
+    )
+    shutil.rmtree(extract_dir)
 
-    # Ensure the .git/info directory exists
-    if not os.path.exists(git_info_dir):
-        os.makedirs(git_info_dir)
 
-    # Create the exclude file if it does not exist
-    if not os.path.isfile(exclude_file_path):
-        open(exclude_file_path, "w").close()
+@traced("Extracting release")
+def extract_release_archive(release_archive, boost_lib_versions, registry_state):
+    """
+    Extract module sources from a Boost release archive, e.g. boost_1_86_0.tar.gz, in one pass.
 
-    # Read the current contents of the file
-    with open(exclude_file_path, "r") as file:
-        lines = file.readlines()
+    Each libs/<library> folder in the archive is extracted straight into the matching module's
+    "diffed_sources" folder, as if it came from the module's own archive. Only modules whose newest
+    version is the release's version, and whose source hasn't been extracted yet, are taken from
+    the archive. Their download and extraction are recorded in registry_state, so setup carries on
+    from the baseline.
 
-    # Check if the pattern already exists in the file
-    if any(exclude_pattern in line for line in lines):
-        logging.info(f"'{exclude_pattern}' already exists in exclude file.")
+    A library's copy in the release can differ a little from its own archive, e.g. by including
+    built documentation. The baseline is made from whatever was extracted, so patches still only
+    hold our changes.
+
+    :param release_archive: The path or url of the archive, in any format tarfile can stream.
+    :param boost_lib_versions: The module version folders to extract sources for.
+    :return: The version folders whose sources were extracted.
+    """
+    import tarfile
+    import tempfile
+
+    release_name = os.path.basename(urllib.parse.urlsplit(release_archive).path)
+    boost_lib_versions = [
+        version
+        for version in boost_lib_versions
+        if not os.path.exists(get_source_dir(version))
+    ]
+    extracted = {}  # Version folder -> (extract folder, strip_prefix)
+
+    def extract(stream):
+        # Start from scratch, as this is called again if the download is retried
+        for extract_dir, _ in extracted.values():
+            shutil.rmtree(extract_dir, ignore_errors=True)
+        extracted.clear()
+        routes = None
+
+        def route(name):
+            """Get the version folder and path within its source of a member, or None"""
+            # boost_1_86_0/libs/<library>[/<nested library>]/<path>
+            parts = name.split("/")
+            if len(parts) < 4 or parts[1] != "libs":
+                return None
+            for depth in (2, 1):
+                version = routes.get("/".join(parts[2 : 2 + depth]))
+                if version and len(parts) > 2 + depth:
+                    return version, parts[2 + depth :]
+            return None
+
+        with tarfile.open(fileobj=stream, mode="r|*") as tar:
+            for member in tar:
+                if routes is None:
+                    routes = get_release_routes(
+                        member.name.split("/")[0], boost_lib_versions
+                    )
+                destination = route(member.name)
+                if destination is None:
+                    continue
+                version, path = destination
+
+                if version not in extracted:
+                    extract_dir = os.path.join(
+                        get_diffed_sources_dir(version), ".extracting"
+                    )
+                    shutil.rmtree(extract_dir, ignore_errors=True)
+                    extracted[version] = (
+                        extract_dir,
+                        load_source_json(version).get("strip_prefix", ""),
+                    )
+                extract_dir, strip_prefix = extracted[version]
+
+                # Hard links name another member, which has to be in the same library
+                if member.islnk():
+                    link_destination = route(member.linkname)
+                    if link_destination is None or link_destination[0] != version:
+                        continue
+                    member.linkname = "/".join([strip_prefix, *link_destination[1]])
+
+                member.name = "/".join([strip_prefix, *path])
+                tar.extract(member, extract_dir)
+
+    if "://" in release_archive:
+        if offline_mode:
+            logging.error(f"Offline, so {release_archive} can't be downloaded")
+            return []
+
+        # The archive is read as it downloads, and only kept until it's been read
+        with tempfile.TemporaryDirectory() as temp_dir:
+            if not download(
+                release_archive, os.path.join(temp_dir, release_name), None, extract
+            ):
+                extracted.clear()
     else:
-        # Append the pattern to the file
-        with open(exclude_file_path, "a") as file:
-            file.write(f"\n{exclude_pattern}\n")
+        try:
+            with open(release_archive, "rb") as f:
+                extract(f)
+        except (OSError, tarfile.TarError) as e:
+            logging.error(f"Error reading {release_archive}: {e}")
+            for extract_dir, _ in extracted.values():
+                shutil.rmtree(extract_dir, ignore_errors=True)
+            extracted.clear()
+
+    for version, (extract_dir, strip_prefix) in extracted.items():
+        finish_extract(get_diffed_sources_dir(version), strip_prefix)
+        registry_state.update(version, archive=release_name, extracted=True)
+
+    logging.info(
+        f"Extracted {len(extracted)} of {len(boost_lib_versions)} modules from {release_name}"
+    )
+    return list(extracted)
 
 
-def patch_generator(registry_dir):
-    page_title = "Module Patch Generator"
+def get_release_routes(release_dir_name, boost_lib_versions):
+    """
+    Match the library folders in a Boost release to module version folders, e.g. "asio" and
+    "numeric/conversion" in boost_1_86_0 to the 1.86.0 folders of boost.asio and
+    boost.numeric_conversion. Modules at other versions aren't matched.
 
-    # base_commit_choice = button_dialog(
-    #     title=page_title,
-    #     text="Using commit "
-    #     + base_git_commit_hash
-    #     + " as base. Changes will be calculated since then.",
-    #     buttons=[
-    #         ("Confirm", True),
-    #         ("Change Commit", False),
-    #     ],
-    #     style=get_custom_style(),
-    # ).run()
+    :param release_dir_name: The release's top folder, e.g. boost_1_86_0.
+    :param boost_lib_versions: The module version folders that can be matched.
+    :return: A dict of library folder under libs to version folder.
+    """
+    match = re.fullmatch(r"boost_(\d+)_(\d+)_(\d+)", release_dir_name)
+    if not match:
+        logging.error(f"{release_dir_name} doesn't look like a Boost release")
+        return {}
+    release_version = ".".join(match.groups())
+
+    routes = {}
+    for version in boost_lib_versions:
+        version_name = os.path.basename(version)
+        if version_name != release_version and not version_name.startswith(
+            release_version + "."
+        ):
+            continue
 
-    # if not base_commit_choice:
-    #     base_git_commit_hash = input_dialog(
-    #         title=page_title,
-    #         text="Please enter the commit hash to use as base:",
-    #         style=get_custom_style(),
-    #     ).run()
+        library = os.path.basename(os.path.dirname(version)).removeprefix("boost.")
+        routes[library] = version
+        # Libraries nested in another's folder are named after both, e.g. numeric_conversion
+        if "_" in library:
+            routes.setdefault(library.replace("_", "/", 1), version)
+    return routes
 
-    # # Detect changed modules since commit
-    # updated_modules = detect_changed_modules(registry_dir, base_git_commit_hash)
 
-    # Detect modules that haven't been bumped & need to be
-    bump_modules = detect_not_bumped(
-        registry_dir, updated_modules, base_git_commit_hash
+def get_diffed_sources_dir(boost_lib_version):
+    """Get the "diffed_sources" folder of the module a version folder belongs to"""
+    return os.path.join(os.path.dirname(boost_lib_version), "diffed_sources")
+
+
+def get_source_dir(boost_lib_version):
+    """Get the folder a version folder's source is extracted to, based on its strip_prefix"""
+    return os.path.join(
+        get_diffed_sources_dir(boost_lib_version),
+        load_source_json(boost_lib_version).get("strip_prefix", ""),
     )
 
-    # If there are modules to bump, ask user if they want to continue
-    if bump_modules:  # TODO Also add in transitive bumps!
-        choice = radiolist_dialog(
-            title=page_title,
-            text="The following modules have been changed and need a version bump:",
-            values=[os.path.basename(module) for module in bump_modules],
-            ok_text="Bump Versions",
-            cancel_text="Cancel",
-            style=get_custom_style(),
-        ).run()
 
-        if choice:
-            # bump_versions(bump_modules) # TODO
-            print(choice)
+def load_source_json(boost_lib_version):
+    """Read the source.json of a version folder"""
+    with open(
+        os.path.join(boost_lib_version, module_source_file_name), "r"
+    ) as source_json_file:
+        return json.load(source_json_file)
+
+
+def extract_archive(fileobj, mode, extract_dir):
+    """Extract an archive file object into an empty extract_dir"""
+    import tarfile
+
+    if os.path.exists(extract_dir):
+        shutil.rmtree(extract_dir)
+
+    with tarfile.open(fileobj=fileobj, mode=mode) as tar:
+        tar.extractall(path=extract_dir)
+
+
+def parse_integrity(integrity):
+    """Split an SRI string such as "sha256-<base64 digest>" into (algorithm, digest)"""
+    algorithm, _, digest = integrity.partition("-")
+    if algorithm not in ("sha256", "sha384", "sha512") or not digest:
+        raise ValueError(f"Unsupported integrity value: {integrity}")
+    return algorithm, digest
+
+
+def make_integrity(hasher):
+    """Format a finished hashlib hasher as an SRI string"""
+    return f"{hasher.name}-{base64.b64encode(hasher.digest()).decode()}"
+
+
+def file_integrity(path, algorithm="sha256"):
+    """Calculate the SRI string of a file"""
+    hasher = hashlib.new(algorithm)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(download_chunk_size), b""):
+            hasher.update(chunk)
+    return make_integrity(hasher)
+
+
+def cached_archive_path(integrity):
+    """Get the path an archive with the given integrity is cached at"""
+    algorithm, digest = parse_integrity(integrity)
+    return os.path.join(
+        archive_cache_dir, f"{algorithm}-{base64.b64decode(digest).hex()}.tar.gz"
+    )
+
+
+def archive_matches(tar_path, integrity):
+    """Check whether an archive on disk has the given integrity"""
+    if not integrity:
+        return True  # Nothing to check against
+
+    # Archives linked from the cache were verified on their way in
+    cached_path = cached_archive_path(integrity)
+    if os.path.exists(cached_path) and os.path.samefile(tar_path, cached_path):
+        return True
+
+    return file_integrity(tar_path, parse_integrity(integrity)[0]) == integrity
+
+
+def link_cached_archive(integrity, tar_path):
+    """Place the cached archive with the given integrity at tar_path, returning False on a miss"""
+    if not integrity:
+        return False
+
+    cached_path = cached_archive_path(integrity)
+    try:
+        link_or_copy(cached_path, tar_path)
+    except FileNotFoundError:
+        return False
+
+    os.utime(cached_path)  # Mark as recently used
+    return True
+
+
+def add_to_archive_cache(tar_path, integrity):
+    """Add a verified archive to the archive cache, evicting old archives if it grows too big"""
+    if not integrity:
+        return
+
+    cached_path = cached_archive_path(integrity)
+    if os.path.exists(cached_path):
+        os.utime(cached_path)  # Mark as recently used
+        return
+
+    # Link under a temporary name first so other workers never see a partial file
+    os.makedirs(archive_cache_dir, exist_ok=True)
+    temp_path = f"{cached_path}.{threading.get_ident()}.tmp"
+    link_or_copy(tar_path, temp_path)
+    os.replace(temp_path, cached_path)
+
+    evict_archive_cache()
+
+
+def link_or_copy(src, dst, hardlink=True):
+    """
+    Hardlink src to dst, falling back to a reflink and then a plain copy across filesystems. Files
+    someone may edit in place shouldn't be hardlinked, as the edit would change both, so
+    hardlink=False skips straight to the reflink.
+    """
+    if hardlink:
+        try:
+            os.link(src, dst)
+            return
+        except FileNotFoundError:
+            raise
+        except OSError:
+            pass
+
+    # Copy-on-write clone where the filesystem supports it (btrfs, xfs, ...)
+    try:
+        import fcntl
+
+        with open(src, "rb") as src_file, open(dst, "wb") as dst_file:
+            fcntl.ioctl(dst_file.fileno(), 0x40049409, src_file.fileno())  # FICLONE
+        return
+    except (ImportError, OSError):
+        pass
+
+    shutil.copyfile(src, dst)
+
+
+_archive_cache_lock = threading.Lock()
+
+
+def evict_archive_cache():
+    """Delete the least recently used archives until the cache fits in archive_cache_max_bytes"""
+    with _archive_cache_lock:
+        archives = []
+        for entry in os.scandir(archive_cache_dir):
+            if entry.name.endswith(".tar.gz"):
+                stat = entry.stat()
+                archives.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total_size = sum(size for _, size, _ in archives)
+        for _, size, path in sorted(archives):
+            if total_size <= archive_cache_max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total_size -= size
+
+
+class TeeReader:
+    """
+    Read-only file object over a stream of byte chunks, copying every chunk to another file as it
+    is read. This lets tarfile decode a download while it is still being saved to disk.
+    """
+
+    def __init__(self, chunks, copy_file):
+        self.chunks = chunks
+        self.copy_file = copy_file
+        self.buffer = b""
+        self.offset = 0
+
+    def read(self, size=-1):
+        pieces = []
+        while size != 0:
+            # Refill from the stream once the current chunk is used up
+            if self.offset == len(self.buffer):
+                self.buffer = next(self.chunks, b"")
+                self.offset = 0
+                if not self.buffer:
+                    break
+                self.copy_file.write(self.buffer)
+
+            end = len(self.buffer) if size < 0 else self.offset + size
+            piece = self.buffer[self.offset : end]
+            self.offset += len(piece)
+            pieces.append(piece)
+            if size > 0:
+                size -= len(piece)
+        return b"".join(pieces)
+
+    def drain(self):
+        """Read (and so copy) whatever the consumer left unread, e.g. trailing tar padding"""
+        while self.read(download_chunk_size):
+            pass
+
+
+_http_session = None
+_http_lock = threading.Lock()
+_host_semaphores = {}
+
+
+def get_http_session():
+    """Get the pooled session shared by all download workers, creating it on first use"""
+    import requests
+    from requests.adapters import HTTPAdapter
+
+    global _http_session
+    with _http_lock:
+        if _http_session is None:
+            # Keep enough connections alive per host that no worker needs a fresh TLS handshake
+            adapter = HTTPAdapter(
+                pool_connections=download_per_host_limit,
+                pool_maxsize=download_per_host_limit,
+            )
+            _http_session = requests.Session()
+            _http_session.mount("https://", adapter)
+            _http_session.mount("http://", adapter)
+        return _http_session
+
+
+def get_host_semaphore(url):
+    """Get the semaphore limiting concurrent transfers to the host of url"""
+    host = urllib.parse.urlsplit(url).netloc
+    with _http_lock:
+        if host not in _host_semaphores:
+            _host_semaphores[host] = threading.BoundedSemaphore(download_per_host_limit)
+        return _host_semaphores[host]
+
+
+def download(url, dest_path, integrity=None, stream_consumer=None):
+    """
+    Download url to dest_path with whichever backend is configured, see download_file and
+    AsyncDownloader. The asyncio backend hands over whole files, so downloads with a stream_consumer
+    always use download_file.
+
+    :return: True if the file was downloaded (and verified), False otherwise.
+    """
+    async_downloader = get_async_downloader()
+    if async_downloader and not stream_consumer:
+        return async_downloader.download(url, dest_path, integrity)
+    return download_file(url, dest_path, stream_consumer, integrity)
+
+
+def download_file(url, dest_path, stream_consumer=None, integrity=None):
+    """
+    Stream url to dest_path in chunks on this thread, with requests. Retries and integrity checks
+    are done by download_with_retries.
+
+    :param url: The url to download.
+    :param dest_path: Where to write the downloaded file.
+    :param stream_consumer: Optional function given a file object reading the download as it
+        arrives. It is called again from scratch if the download has to be retried.
+    :param integrity: Optional SRI string the download is verified against as it streams.
+    :return: True if the file was downloaded (and verified), False otherwise.
+    """
+    import requests
+    import tarfile
+
+    def transfer(f, hasher):
+        with get_host_semaphore(url):
+            with get_http_session().get(
+                url, stream=True, timeout=download_timeout
+            ) as response:
+                response.raise_for_status()
+                chunks = downloaded_bytes.counted(
+                    response.iter_content(download_chunk_size)
+                )
+                if tracer.enabled:
+                    chunks = tracer.counted(chunks)
+                if hasher:
+                    chunks = hash_chunks(chunks, hasher)
+                if stream_consumer:
+                    stream = TeeReader(chunks, f)
+                    stream_consumer(stream)
+                    stream.drain()
+                else:
+                    for chunk in chunks:
+                        f.write(chunk)
+
+    return download_with_retries(
+        url,
+        dest_path,
+        transfer,
+        (requests.RequestException,),
+        integrity,
+        # The archive itself is broken, downloading it again won't fix that
+        fatal_errors=(tarfile.TarError,),
+    )
+
+
+def download_with_retries(
+    url, dest_path, transfer, retry_errors, integrity=None, fatal_errors=()
+):
+    """
+    The retry and integrity policy shared by the download backends. Each attempt is retried with
+    exponential backoff if it fails in a way that might not happen again.
+
+    The file is written to a ".part" file first and only renamed into place once complete and
+    verified, so an interrupted download is never mistaken for a finished one.
+
+    :param url: The url being downloaded, for is_retryable and the log.
+    :param dest_path: Where to write the downloaded file.
+    :param transfer: The backend's function making one attempt. It is given the open ".part" file
+        and a hasher (or None), and writes the whole response to the file, feeding each chunk to
+        the hasher.
+    :param retry_errors: The exceptions transfer raises for failed requests.
+    :param integrity: Optional SRI string the download is verified against.
+    :param fatal_errors: Exceptions that fail the download straight away.
+    :return: True if the file was downloaded (and verified), False otherwise.
+    """
+    partial_path = dest_path + ".part"
+    retry_delay = download_retry_backoff
+
+    for attempt in range(1, download_max_retries + 1):
+        try:
+            hasher = hashlib.new(parse_integrity(integrity)[0]) if integrity else None
+            with open(partial_path, "wb") as f:
+                transfer(f, hasher)
+
+            # A mismatch means the archive changed upstream, asking again won't help
+            if hasher and make_integrity(hasher) != integrity:
+                logging.error(
+                    f"Integrity mismatch for {url}: expected {integrity}, got {make_integrity(hasher)}"
+                )
+                break
+
+            os.replace(partial_path, dest_path)
+            return True
+
+        except fatal_errors as e:
+            logging.error(f"Error downloading {url}: {e}")
+            break
+
+        except retry_errors as e:
+            if not is_retryable(e) or attempt == download_max_retries:
+                logging.error(f"Error downloading {url}: {e}")
+                break
+            logging.warning(
+                f"Download of {url} failed ({e}), retrying in {retry_delay:.0f}s"
+            )
+            time.sleep(retry_delay)
+            retry_delay *= 2
+
+    if os.path.exists(partial_path):
+        os.remove(partial_path)
+    return False
+
+
+def is_retryable(error):
+    """Check whether a failed download is worth trying again"""
+    # Client errors (other than rate limiting) won't go away by asking again
+    response = getattr(error, "response", None)
+    status = response.status_code if response is not None else None
+    return status is None or status == 429 or status >= 500
+
+
+class ByteCounter:
+    """A running total of bytes that any thread can add to"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.total = 0
+
+    def add(self, count):
+        with self.lock:
+            self.total += count
+
+    def counted(self, chunks):
+        """Pass chunks through unchanged, adding up their bytes"""
+        for chunk in chunks:
+            self.add(len(chunk))
+            yield chunk
+
+
+downloaded_bytes = ByteCounter()
+
+_async_downloader = None
+_async_downloader_checked = False
+
+
+def get_download_workers():
+    """How many threads to download with"""
+    # Async download workers only wait for the event loop, so there's one per transfer in flight
+    return async_download_limit if get_async_downloader() else download_threads
+
+
+def get_async_downloader():
+    """
+    Get the AsyncDownloader shared by all download workers, creating it on first use. Returns
+    None if the threaded downloader is to be used, including when httpx isn't installed.
+    """
+    global _async_downloader, _async_downloader_checked
+    with _http_lock:
+        if download_backend != "asyncio":
+            return None
+        if not _async_downloader_checked:
+            _async_downloader_checked = True
+            if importlib.util.find_spec("httpx") is None:
+                logging.warning(
+                    "The asyncio download backend needs httpx (pip install httpx h2), "
+                    "downloading with threads instead"
+                )
+            else:
+                _async_downloader = AsyncDownloader(async_download_limit)
+        return _async_downloader
+
+
+class AsyncDownloader:
+    """
+    Downloads files on an asyncio event loop running in a background thread, with httpx.
+
+    Any thread can call download, which waits for its file just like download_file, so it slots
+    into the setup pipeline in place of download_file. All transfers share one client, so where a
+    host speaks HTTP/2 they're multiplexed over one connection rather than needing one each. Up to
+    limit transfers are in flight at once, however many workers are waiting. Retries and integrity
+    checks are download_with_retries', run from the waiting thread.
+    """
+
+    def __init__(self, limit):
+        import asyncio
+        import httpx
+
+        self.http2 = importlib.util.find_spec("h2") is not None
+        self.client = httpx.AsyncClient(
+            http2=self.http2,
+            timeout=httpx.Timeout(
+                download_timeout[1], connect=download_timeout[0], pool=None
+            ),
+            limits=httpx.Limits(max_connections=limit, max_keepalive_connections=limit),
+            follow_redirects=True,  # As requests does, GitHub archives redirect to codeload
+        )
+        self.transfer_slots = asyncio.Semaphore(limit)
+        self.host_slots = {}
+        self.loop = asyncio.new_event_loop()
+        threading.Thread(
+            target=self.loop.run_forever, name="Async downloads", daemon=True
+        ).start()
+
+    def download(self, url, dest_path, integrity=None):
+        """Download url to dest_path, waiting until it's done. Returns True on success"""
+        import asyncio
+        import httpx
+
+        def transfer(f, hasher):
+            byte_count = ByteCounter()
+            try:
+                asyncio.run_coroutine_threadsafe(
+                    self.transfer(url, f, hasher, byte_count), self.loop
+                ).result()
+            finally:
+                # Counted here, against the phase waiting for it
+                tracer.add_bytes(byte_count.total)
+
+        return download_with_retries(
+            url, dest_path, transfer, (httpx.HTTPError,), integrity
+        )
+
+    def get_host_slots(self, url):
+        """Get the semaphore limiting concurrent transfers to the host of url"""
+        import asyncio
+
+        parts = urllib.parse.urlsplit(url)
+        if parts.netloc not in self.host_slots:
+            # HTTP/2 is only negotiated over https. Without it, each transfer needs a connection
+            multiplexed = self.http2 and parts.scheme == "https"
+            self.host_slots[parts.netloc] = asyncio.Semaphore(
+                async_download_limit if multiplexed else download_per_host_limit
+            )
+        return self.host_slots[parts.netloc]
+
+    async def transfer(self, url, f, hasher, byte_count):
+        """Make one attempt at downloading url to the open file f, see download_with_retries"""
+        async with self.transfer_slots, self.get_host_slots(url):
+            async with self.client.stream("GET", url) as response:
+                response.raise_for_status()
+
+                # Writing and hashing a chunk is quick next to waiting for the network, so it's
+                # done on the event loop
+                async for chunk in response.aiter_bytes(download_chunk_size):
+                    if hasher:
+                        hasher.update(chunk)
+                    f.write(chunk)
+                    byte_count.add(len(chunk))
+                    downloaded_bytes.add(len(chunk))
+
+
+def hash_chunks(chunks, hasher):
+    """Pass chunks through unchanged, feeding each one to hasher on the way"""
+    for chunk in chunks:
+        hasher.update(chunk)
+        yield chunk
+
+
+@traced("Creating baseline")
+def create_baseline(boost_source, fast_baseline=False):
+    """
+    Initialize a git repository in a module's source so we can track changes.
+
+    :param boost_source: The module's source folder.
+    :param fast_baseline: Build the baseline straight from the archive with import_baseline if
+        the source hasn't been extracted yet.
+    :return: True if a new baseline was created, False if it already existed or failed.
+    """
+    # Check if the .git directory exists
+    if os.path.exists(os.path.join(boost_source, ".git")):
+        return False
+
+    # Build the baseline commit straight from the archive if it hasn't been extracted yet
+    if fast_baseline and not os.path.exists(boost_source):
+        return import_baseline(
+            os.path.join(os.path.dirname(boost_source), "downloaded.tar.gz"),
+            boost_source,
+        )
+
+    commit_baseline(boost_source)
+    return True
+
+
+@traced("Applying patch")
+def apply_source_patch(boost_source, boost_lib_version):
+    """Apply a version folder's patch to the module's source, returning True on success"""
+    try:
+        # Construct the patch file path
+        patches_path = os.path.join(boost_lib_version, "patches", "patch.diff")
+
+        result = subprocess.run(
+            ["git", "apply", "--whitespace=nowarn", patches_path],
+            cwd=boost_source,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+        )
+        if result.stderr:
+            logging.error(f"Error applying patches: {result.stderr.decode()}")
+        return result.returncode == 0
+
+    except subprocess.CalledProcessError as e:
+        logging.error(f"An error occurred: {e}")
+        return False
+
+
+def get_head_commit(repo_dir):
+    """Get the commit hash HEAD points to in a git repository"""
+    return subprocess.run(
+        ["git", "rev-parse", "HEAD"],
+        cwd=repo_dir,
+        stdout=subprocess.PIPE,
+        text=True,
+    ).stdout.strip()
+
+
+def commit_baseline(boost_source):
+    """Commit an extracted source as-is, so changes to it can be tracked"""
+    # Initialize the git repository, suppressing stdout and capturing stderr
+    result = subprocess.run(
+        ["git", "init", "-b", "main"],
+        cwd=boost_source,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+    )
+    if result.stderr:
+        logging.error(f"Error initializing repository: {result.stderr.decode()}")
+
+    # Add all files to the staging area
+    result = subprocess.run(
+        ["git", "add", "."],
+        cwd=boost_source,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,  # Suppress some annoying "CRLF will be replaced by LF" warnings
+    )
+    if result.stderr:
+        logging.error(f"Error adding files: {result.stderr.decode()}")
+
+    # Commit the changes
+    result = subprocess.run(
+        [
+            "git",
+            "commit",
+            "--no-gpg-sign",
+            "-m",
+            "Initial commit",
+        ],  # GPG has resource contention with multithreading and isn't needed here anyway
+        cwd=boost_source,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+    )
+    if result.stderr:
+        logging.error(f"Error committing files: {result.stderr.decode()}")
+
+
+def import_baseline(tar_path, boost_source):
+    """
+    Create a module's source folder and its baseline commit straight from the archive.
+
+    Rather than extracting, then having "git add" read and hash every file again, the archive is
+    streamed once into git fast-import and git checks the files out itself. Files containing
+    carriage returns are instead written and added normally, so .gitattributes line ending rules
+    give the same blobs "git add" would. The result matches commit_baseline, except that files a
+    .gitignore in the archive would have excluded are still committed.
+
+    :param tar_path: The module's downloaded archive.
+    :param boost_source: The source folder to create, named after the archive's strip_prefix.
+    :return: True if the baseline was created, False otherwise.
+    """
+    import tarfile
+
+    diffed_sources_dir, strip_prefix = os.path.split(boost_source)
+    import_root = os.path.join(diffed_sources_dir, ".extracting")
+    import_dir = os.path.join(import_root, strip_prefix)
+    if os.path.exists(import_root):
+        shutil.rmtree(import_root)
+    os.makedirs(import_dir)
+
+    def git(*command, **kwargs):
+        return subprocess.run(
+            ["git", *command],
+            cwd=import_dir,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            **kwargs,
+        )
+
+    result = git("init", "-b", "main")
+    if result.returncode:
+        logging.error(f"Error initializing repository: {result.stderr.decode()}")
+        return False
+
+    # Use the same identity "git commit" would
+    identities = []
+    for variable in ["GIT_AUTHOR_IDENT", "GIT_COMMITTER_IDENT"]:
+        result = git("var", variable)
+        if result.returncode:
+            logging.error(f"Error committing files: {result.stderr.decode()}")
+            return False
+        identities.append(result.stdout.strip())
+
+    fast_import = subprocess.Popen(
+        ["git", "fast-import", "--quiet", "--done"],
+        cwd=import_dir,
+        stdin=subprocess.PIPE,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+    )
+    tree_entries = []
+    blobs = {}  # path -> (mode, mark), for hard links to reuse
+    directories = []
+    crlf_files = {}
+    prefix = strip_prefix + "/"
+
+    try:
+        # Send every file to git as a blob as it comes out of the archive
+        with tarfile.open(tar_path, "r|gz") as tar:
+            for member in tar:
+                if not member.name.startswith(prefix):
+                    continue
+                path = member.name[len(prefix) :]
+
+                if member.isdir():
+                    directories.append(path)
+                    continue
+                elif member.islnk():
+                    # Hard links point at an earlier member, so share its blob and mode
+                    target = member.linkname[len(prefix) :]
+                    if target in blobs:
+                        tree_entries.append((*blobs[target], path))
+                    elif target in crlf_files:
+                        crlf_files[path] = crlf_files[target]
+                    else:
+                        logging.warning(
+                            f"Skipping {member.name}, its link target isn't in the archive"
+                        )
+                    continue
+                elif member.issym():
+                    mode, data = b"120000", member.linkname.encode()
+                elif member.isfile():
+                    mode = b"100755" if member.mode & 0o111 else b"100644"
+                    data = tar.extractfile(member).read()
+                else:
+                    logging.warning(
+                        f"Skipping unsupported archive member {member.name}"
+                    )
+                    continue
+
+                if b"\r" in data:
+                    crlf_files[path] = (member.mode, data)
+                    continue
+
+                mark = len(tree_entries) + 1
+                fast_import.stdin.write(
+                    b"blob\nmark :%d\ndata %d\n" % (mark, len(data))
+                )
+                fast_import.stdin.write(data)
+                fast_import.stdin.write(b"\n")
+                tree_entries.append((mode, mark, path))
+                blobs[path] = (mode, mark)
+
+        # Then commit them all as the baseline
+        message = b"Initial commit\n"
+        fast_import.stdin.write(
+            b"commit refs/heads/main\nauthor %s\ncommitter %s\ndata %d\n%s\n"
+            % (*identities, len(message), message)
+        )
+        for mode, mark, path in tree_entries:
+            fast_import.stdin.write(
+                b"M %s :%d %s\n" % (mode, mark, fast_import_path(path))
+            )
+        fast_import.stdin.write(b"done\n")
+
+    except (OSError, tarfile.TarError) as e:
+        fast_import.kill()
+        logging.error(f"Error importing {tar_path}: {e}")
+        return False
+
+    finally:
+        stderr = fast_import.communicate()[1]
+
+    if fast_import.returncode:
+        logging.error(f"Error importing {tar_path}: {stderr.decode()}")
+        return False
+
+    # Check the commit out, which writes the files along with a fully populated index
+    result = git("read-tree", "-u", "--reset", "HEAD")
+    if result.returncode:
+        logging.error(f"Error checking out files: {result.stderr.decode()}")
+        return False
+
+    # Git doesn't track directories, but extracting would have created empty ones too
+    for path in directories:
+        os.makedirs(os.path.join(import_dir, path), exist_ok=True)
+
+    if crlf_files:
+        for path, (mode, data) in crlf_files.items():
+            file_path = os.path.join(import_dir, path)
+            os.makedirs(os.path.dirname(file_path), exist_ok=True)
+            with open(file_path, "wb") as f:
+                f.write(data)
+            os.chmod(file_path, mode)
+
+        paths = [path.encode("utf-8", "surrogateescape") for path in crlf_files]
+        result = git(
+            "add",
+            "--pathspec-from-file=-",
+            "--pathspec-file-nul",
+            input=b"\0".join(paths),
+        )
+        if not result.returncode:
+            result = git("commit", "--amend", "--no-gpg-sign", "-m", "Initial commit")
+        if result.returncode:
+            logging.error(f"Error committing files: {result.stderr.decode()}")
+            return False
+
+    os.replace(import_dir, boost_source)
+    shutil.rmtree(import_root)
+    return True
+
+
+def fast_import_path(path):
+    """Encode a path for a git fast-import command, C-style quoting it where required"""
+    encoded = path.encode("utf-8", "surrogateescape")
+    if encoded.startswith(b'"') or b"\n" in encoded:
+        for char, escaped in [(b"\\", b"\\\\"), (b'"', b'\\"'), (b"\n", b"\\n")]:
+            encoded = encoded.replace(char, escaped)
+        encoded = b'"' + encoded + b'"'
+    return encoded
+
+
+def set_git_exclude(registry_dir):
+    git_info_dir = os.path.join(registry_dir, ".git", "info")
+    exclude_file_path = os.path.join(git_info_dir, "exclude")
+    exclude_pattern = "diffed_sources/"
+
+    # Ensure the .git/info directory exists
+    if not os.path.exists(git_info_dir):
+        os.makedirs(git_info_dir)
+
+    # Create the exclude file if it does not exist
+    if not os.path.isfile(exclude_file_path):
+        open(exclude_file_path, "w").close()
+
+    # Read the current contents of the file
+    with open(exclude_file_path, "r") as file:
+        lines = file.readlines()
+
+    # Check if the pattern already exists in the file
+    if any(exclude_pattern in line for line in lines):
+        logging.info(f"'{exclude_pattern}' already exists in exclude file.")
+    else:
+        # Append the pattern to the file
+        with open(exclude_file_path, "a") as file:
+            file.write(f"\n{exclude_pattern}\n")
+
+
+def patch_generator(registry_dir):
+    from prompt_toolkit.shortcuts import radiolist_dialog
+
+    page_title = "Module Patch Generator"
+
+    # base_commit_choice = button_dialog(
+    #     title=page_title,
+    #     text="Using commit "
+    #     + base_git_commit_hash
+    #     + " as base. Changes will be calculated since then.",
+    #     buttons=[
+    #         ("Confirm", True),
+    #         ("Change Commit", False),
+    #     ],
+    #     style=get_custom_style(),
+    # ).run()
+
+    # if not base_commit_choice:
+    #     base_git_commit_hash = input_dialog(
+    #         title=page_title,
+    #         text="Please enter the commit hash to use as base:",
+    #         style=get_custom_style(),
+    #     ).run()
+
+    # # Detect changed modules since commit
+    # updated_modules = detect_changed_modules(registry_dir, base_git_commit_hash)
+
+    # Detect modules that haven't been bumped & need to be
+    bump_modules = detect_not_bumped(
+        registry_dir, updated_modules, base_git_commit_hash
+    )
+
+    # If there are modules to bump, ask user if they want to continue
+    if bump_modules:
+        choice = radiolist_dialog(
+            title=page_title,
+            text="The following modules have been changed and need a version bump:",
+            values=[os.path.basename(module) for module in bump_modules],
+            ok_text="Bump Versions",
+            cancel_text="Cancel",
+            style=get_custom_style(),
+        ).run()
+
+        if choice:
+            # bump_versions(bump_modules) # TODO
+            print(choice)
+
+        # TODO only patch ones that have been bumped
+
+        # Detect what modules have changes
+        source_updated_modules = detect_changed_sources(modules_dir)
+
+        if source_updated_modules:
+            choice = radiolist_dialog(
+                title=page_title,
+                text="The following modules will have their patches updated and hashed:",
+                values=[os.path.basename(module) for module in source_updated_modules],
+                ok_text="Update Patches",
+                cancel_text="Cancel",
+                style=get_custom_style(),
+            ).run()
+            if choice:
+                patch_and_hash(registry_dir, source_updated_modules)
+        else:  # No changes
+            # TODO inform of no changes
+            pass
+
+    # if confirm:
+    #     text = input_dialog(title="Enter Text", text="Please enter some text:").run()
+    #     message_dialog(title="Entered Text", text=f"You entered: {text}").run()
+    # else:
+    #     message_dialog(title="Cancelled", text="Operation cancelled.").run()
+
+    if choice:
+        pass
+
+
+def get_base_commit(
+    registry_dir,
+    upstream_remote="upstream",
+    upstream_branch="main",
+    local_branch="HEAD",
+    interactive=True,
+):
+    """
+    Find the registry commit our changes are based on, letting the user pick another one if
+    interactive. Returns None if there isn't one and nothing else was picked.
+    """
+    # Check if the 'upstream' remote exists, add it if not
+    result = subprocess.run(
+        ["git", "remote"],
+        cwd=registry_dir,
+        stdout=subprocess.PIPE,
+        text=True,
+    )
+
+    if "upstream" not in result.stdout.strip().split("\n"):
+        subprocess.run(
+            ["git", "remote", "add", "upstream", "https://github.com/bazelbuild/bazel-central-registry"],
+            cwd=registry_dir,
+        )
+
+    # Fetch the latest information from the upstream
+    subprocess.run(
+        ["git", "fetch", upstream_remote, upstream_branch],
+        cwd=registry_dir,
+    )
+
+    # Find the last commit upstream that we based our changes on
+    base_git_commit_hash = find_git_divergence(
+        registry_dir, upstream_remote, upstream_branch, local_branch
+    )
+
+    if not interactive:
+        return base_git_commit_hash
+
+    from prompt_toolkit.shortcuts import input_dialog
+
+    commit_details = ""
+    if base_git_commit_hash:
+        # Get the commit details for display to user
+        for key, value in get_commit_details(
+            registry_dir, base_git_commit_hash
+        ).items():
+            commit_details += f"{key}: {value}\n"
+    else:
+        base_git_commit_hash = "** No Commit Found **"
+
+    # Display confirmation dialogue
+    alternate_commit = input_dialog(
+        title="Verify Base Commit",
+        text=f"We detected {base_git_commit_hash} as the most recent commit in the registry prior to your changes. If you'd like to track changes that occurred after another commit, please enter it below.\n\nCommit {base_git_commit_hash}:\n{commit_details}",
+        style=get_custom_style(),
+    ).run()
+
+    if alternate_commit:
+        base_git_commit_hash = alternate_commit
+    elif base_git_commit_hash == "** No Commit Found **":
+        base_git_commit_hash = None
+
+    return base_git_commit_hash
+
+
+@traced("Finding base commit")
+def find_git_divergence(
+    registry_dir,
+    upstream_remote="upstream",
+    upstream_branch="main",
+    local_branch="HEAD",
+):
+    upstream = f"{upstream_remote}/{upstream_branch}"
+
+    # Get local commits with their parents, newest first
+    result = subprocess.run(
+        ["git", "rev-list", "--parents", f"{upstream}..{local_branch}"],
+        cwd=registry_dir,
+        stdout=subprocess.PIPE,
+        text=True,
+    )
+    local_commits = [line.split() for line in result.stdout.splitlines()]
+    local_hashes = {commit[0] for commit in local_commits}
+
+    # Scenario 1: Most recent commit in main(upstream) with a parent from your branch. Upstream
+    # history is streamed once, remembering every commit for scenario 2 on the way
+    upstream_hashes = set()
+    with subprocess.Popen(
+        ["git", "rev-list", "--parents", upstream],
+        cwd=registry_dir,
+        stdout=subprocess.PIPE,
+        text=True,
+    ) as process:
+        for line in process.stdout:
+            commit_hash, *parents = line.split()
+            if local_hashes.intersection(parents):
+                process.kill()
+                return commit_hash
+            upstream_hashes.add(commit_hash)
+
+    # Scenario 2: Oldest commit of your local branch with a parent in main(upstream)
+    for commit_hash, *parents in reversed(local_commits):  # Start from the oldest
+        for parent in parents:
+            if parent in upstream_hashes:
+                return parent
+
+
+def get_commit_details(registry_dir, commit_hash):
+    # Get every detail from one git show, separated by NUL characters
+    result = subprocess.run(
+        ["git", "show", "-s", "--format=%an%x00%ad%x00%B", commit_hash],
+        cwd=registry_dir,
+        stdout=subprocess.PIPE,
+        text=True,
+    )
+    values = result.stdout.split("\0", 2) + ["", ""]
+    return {
+        key: value.strip() for key, value in zip(["Author", "Date", "Message"], values)
+    }
+
+
+@traced("Detecting changes")
+def detect_changed_sources(boost_source_dirs, use_fsmonitor=None):
+    """
+    Find the sources with changes that haven't been patched yet.
+
+    Sources are checked in parallel with git status. Git's untracked cache lets it skip folders
+    that haven't changed since the last check when looking for new files.
+
+    :param boost_source_dirs: The source folders to check.
+    :param use_fsmonitor: Let git's core.fsmonitor find changed files too, rather than checking
+        every file's stats. Defaults to use_git_fsmonitor.
+    :return: The source folders with changes, in the order given.
+    """
+    if use_fsmonitor is None:
+        use_fsmonitor = use_git_fsmonitor
+
+    results = run_multithreaded_tasks(
+        boost_source_dirs, source_has_changes, None, "Checking", use_fsmonitor
+    )
+    return [result.item for result in results if result.result]
+
+
+@traced("Checking for changes")
+def source_has_changes(source, use_fsmonitor=False):
+    """Check whether a source has changes that haven't been patched yet"""
+    if not os.path.isdir(os.path.join(source, ".git")):
+        return False  # Not set up, so there's nothing to have changed
+
+    # Check the status to see if there are any changes that aren't staged
+    command = ["git", "-c", "core.untrackedCache=true", "status", "--porcelain"]
+    if use_fsmonitor:
+        command[1:1] = ["-c", "core.fsmonitor=true"]
+    result = subprocess.run(
+        command,
+        cwd=source,
+        stdout=subprocess.PIPE,
+        text=True,
+    )
+
+    unstaged_changes = []
+    for line in result.stdout.splitlines():
+        status_code = line[:2]
+
+        if status_code != "A " and not (
+            status_code == "M " and line.endswith(".gitignore")
+        ):
+            file_path = line[3:]
+            unstaged_changes.append(file_path)
+    return bool(unstaged_changes)
+
+
+def stat_snapshot(source):
+    """
+    Digest the path, mtime, size and inode of every file in a source, leaving out its .git folder.
+    Adding, removing or editing any file changes the digest.
+    """
+    hasher = hashlib.blake2b(digest_size=16)
+
+    def add(path):
+        stat = os.stat(path, follow_symlinks=False)
+        hasher.update(
+            f"{path}\0{stat.st_mtime_ns}\0{stat.st_size}\0{stat.st_ino}\n".encode(
+                "utf-8", "surrogateescape"
+            )
+        )
+
+    pending_dirs = [source]
+    while pending_dirs:
+        with os.scandir(pending_dirs.pop()) as entries:
+            for entry in sorted(entries, key=lambda entry: entry.name):
+                if entry.is_dir(follow_symlinks=False):
+                    if entry.name != ".git":
+                        pending_dirs.append(entry.path)
+                else:
+                    add(entry.path)
+
+    return hasher.hexdigest()
+
+
+def watch_sources(
+    registry_dir,
+    boost_source_dirs,
+    registry_state=None,
+    registry_index=None,
+    debounce=None,
+):
+    """
+    Patch sources as they're edited, until interrupted with Ctrl-C.
+
+    Changes are picked up with inotify where possible, or by polling file stats otherwise. Once a
+    source has had no changes for the debounce time, only that source is diffed and its patch,
+    integrity and MODULE.bazel are updated.
+
+    :param registry_dir: The registry the sources belong to.
+    :param boost_source_dirs: The source folders to watch. Sources that aren't set up are skipped.
+    :param registry_state: The RegistryState to record patches in.
+    :param registry_index: The RegistryIndex of the registry.
+    :param debounce: Seconds a source must be quiet before patching it. Defaults to watch_debounce.
+    :return: The number of patches generated.
+    """
+    if debounce is None:
+        debounce = watch_debounce
+    if registry_index is None:
+        registry_index = RegistryIndex(os.path.join(registry_dir, "modules"))
+
+    sources = [
+        source
+        for source in boost_source_dirs
+        if os.path.isdir(os.path.join(source, ".git"))
+    ]
+    if not sources:
+        logging.warning("No sources are set up, so there's nothing to watch")
+        return 0
+
+    try:
+        watcher = InotifyWatcher(sources)
+    except OSError as e:
+        logging.warning(f"Can't use inotify ({e}), polling for changes instead")
+        watcher = PollingWatcher(sources)
+
+    # When each source with changes last changed. Anything edited since the last patch is due now
+    pending = {source: 0 for source in detect_changed_sources(sources)}
+    patched = 0
+    try:
+        while True:
+            now = time.monotonic()
+            ready = [
+                source
+                for source, changed_at in pending.items()
+                if now - changed_at >= debounce
+            ]
+            if ready:
+                for source in ready:
+                    del pending[source]
+                results = patch_and_hash(
+                    registry_dir, ready, registry_state, registry_index
+                )
+                for result in results:
+                    if not result.error:
+                        patched += 1
+                        logging.info(f"Patched {registry_index.module_of(result.item)}")
+
+            if pending:
+                timeout = max(0, debounce - (time.monotonic() - min(pending.values())))
+            else:
+                timeout = watch_poll_interval
+            changed_at = time.monotonic()
+            for source in watcher.wait(timeout):
+                pending[source] = changed_at
+
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
+
+    return patched
+
+
+class InotifyWatcher:
+    """
+    Find which sources have changed using Linux's inotify. Every folder in each source except .git is
+    watched, and new folders are watched as they appear.
+    """
+
+    IN_MODIFY = 0x2
+    IN_ATTRIB = 0x4
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_FROM = 0x40
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_Q_OVERFLOW = 0x4000
+    IN_IGNORED = 0x8000
+    IN_ISDIR = 0x40000000
+    watch_mask = (
+        IN_MODIFY
+        | IN_ATTRIB
+        | IN_CLOSE_WRITE
+        | IN_MOVED_FROM
+        | IN_MOVED_TO
+        | IN_CREATE
+        | IN_DELETE
+    )
+    event_header = struct.Struct("iIII")
+
+    def __init__(self, sources):
+        import ctypes
+        import ctypes.util
+
+        self.sources = list(sources)
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        if not hasattr(self.libc, "inotify_init1"):
+            raise OSError("inotify isn't supported on this platform")
+
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.get_errno = ctypes.get_errno
+
+        self.watches = {}  # Watch descriptor -> (source, folder)
+        try:
+            for source in self.sources:
+                self.watch_tree(source, source)
+        except OSError:
+            self.close()
+            raise
+
+    def watch_tree(self, source, path):
+        """Watch a folder and every folder below it, except .git"""
+        for dir_path, dir_names, _ in os.walk(path):
+            dir_names[:] = [name for name in dir_names if name != ".git"]
+            wd = self.libc.inotify_add_watch(
+                self.fd, os.fsencode(dir_path), self.watch_mask
+            )
+            if wd < 0:
+                error = self.get_errno()
+                if error == errno.ENOSPC:
+                    raise OSError(
+                        error,
+                        "Out of inotify watches, raise fs.inotify.max_user_watches",
+                    )
+                continue  # The folder went away before we got to it
+            self.watches[wd] = (source, dir_path)
+
+    def wait(self, timeout):
+        """Wait up to timeout seconds for changes, returning the set of sources that changed"""
+        changed = set()
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return changed
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return changed
+
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = self.event_header.unpack_from(data, offset)
+            offset += self.event_header.size
+            name = os.fsdecode(data[offset : offset + length].rstrip(b"\0"))
+            offset += length
+
+            if mask & self.IN_Q_OVERFLOW:
+                changed.update(
+                    self.sources
+                )  # Events were dropped, so anything could have changed
+                continue
+            if wd not in self.watches:
+                continue
+            source, dir_path = self.watches[wd]
+            if mask & self.IN_IGNORED:
+                del self.watches[wd]
+                continue
+            if dir_path == source and name == ".git":
+                continue
+
+            changed.add(source)
+            if mask & self.IN_ISDIR and mask & (self.IN_CREATE | self.IN_MOVED_TO):
+                self.watch_tree(source, os.path.join(dir_path, name))
+
+        return changed
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PollingWatcher:
+    """Find which sources have changed by comparing stat snapshots, for when inotify isn't available"""
+
+    def __init__(self, sources):
+        self.snapshots = {source: self.snapshot(source) for source in sources}
+
+    @staticmethod
+    def snapshot(source):
+        try:
+            return stat_snapshot(source)
+        except FileNotFoundError:
+            return None  # Something was deleted mid-scan, so it's changing anyway
+
+    def wait(self, timeout):
+        """Wait timeout seconds, then return the set of sources that changed"""
+        time.sleep(timeout)
+        changed = set()
+        for source, snapshot in self.snapshots.items():
+            new_snapshot = self.snapshot(source)
+            if new_snapshot != snapshot or new_snapshot is None:
+                self.snapshots[source] = new_snapshot
+                changed.add(source)
+        return changed
+
+    def close(self):
+        pass
+
+
+def bump_modules(
+    registry_dir,
+    base_git_commit_hash,
+    updated_sources,
+    registry_index,
+    registry_state,
+    dependency_graph=None,
+):
+    if dependency_graph is None:
+        dependency_graph = DependencyGraph(registry_dir, registry_index)
+    awaiting_bump, transitive_bumps = find_modules_to_bump(
+        registry_dir,
+        base_git_commit_hash,
+        [registry_index.module_of(source) for source in updated_sources],
+        registry_index,
+        dependency_graph,
+    )
+
+    results_array = None
+    if awaiting_bump or transitive_bumps:
+        from prompt_toolkit.shortcuts import checkboxlist_dialog
+
+        # Display confirmation dialogue
+        results_array = checkboxlist_dialog(
+            title="Bump Modules",
+            text="These modules need a version bump! Please select which modules you'd like to bump:",
+            values=[(module, module) for module in awaiting_bump]
+            + [
+                (module, f"{module} (depends on a module above)")
+                for module in transitive_bumps
+            ],
+            style=get_custom_style(),
+        ).run()
+
+    results = []
+    if results_array:
+        results = bump_and_patch(
+            registry_dir,
+            results_array,
+            registry_index,
+            registry_state,
+            dependency_graph,
+        )
+
+    return [result.item for result in results]
+
+
+def find_modules_to_bump(
+    registry_dir,
+    base_git_commit_hash,
+    updated_modules,
+    registry_index,
+    dependency_graph,
+):
+    """
+    Find which modules need a version bump before their changes can be patched in.
+
+    :param updated_modules: The names of the modules with changes.
+    :return: (changed modules needing a bump, modules needing one only because they depend on one
+        of those), each sorted.
+    """
+
+    # If a module's newest version already existed in the base commit, it has been released and
+    # changing it needs a new version. So do the modules depending on it, to pick that version up
+    candidates = dependency_graph.transitive_dependents(updated_modules)
+    base_versions = get_base_versions(
+        registry_dir,
+        base_git_commit_hash,
+        [registry_index[module].dir for module in candidates],
+    )
+
+    def is_released(module):
+        newest_version_dir = registry_index[module].newest_version_dir
+        return bool(newest_version_dir) and os.path.basename(
+            newest_version_dir
+        ) in base_versions.get(module, set())
+
+    awaiting_bump = sorted(module for module in updated_modules if is_released(module))
+    transitive_bumps = [
+        module
+        for module in sorted(
+            dependency_graph.transitive_dependents(awaiting_bump) - set(awaiting_bump)
+        )
+        if is_released(module)
+    ]
+    return awaiting_bump, transitive_bumps
+
+
+def bump_and_patch(
+    registry_dir, modules, registry_index, registry_state, dependency_graph
+):
+    """
+    Bump modules to a new registry version of the same Boost release (e.g. 1.83.0 to
+    1.83.0.bcr.1), then patch them, dependencies before their dependents.
+
+    :return: The patch_and_hash results for every module patched.
+    :raises BumpError: If any module couldn't be bumped, in which case none are.
+    """
+    old_version_dirs = {
+        module: registry_index[module].newest_version_dir for module in modules
+    }
+    new_versions = {
+        module: get_next_registry_version(os.path.basename(version_dir))
+        for module, version_dir in old_version_dirs.items()
+    }
+    bump_versions(registry_index, new_versions)
+
+    # The new versions use the same archives, so their sources stay set up
+    for module, version_dir in old_version_dirs.items():
+        registry_state.carry_over(
+            version_dir, registry_index[module].newest_version_dir
+        )
+    copy_module_bazel_to_sources(registry_index, modules)
+
+    # Dependencies go before their dependents, with each level done in parallel
+    results = []
+    for level in dependency_graph.topological_levels(modules):
+        sources = []
+        for module in level:
+            source = registry_index[module].source_dir
+            if source and os.path.isdir(source):
+                sources.append(source)
+            else:
+                logging.warning(f"{module} needs setting up before it can be patched")
+        if sources:
+            results += patch_and_hash(
+                registry_dir, sources, registry_state, registry_index
+            )
+
+    return results
+
+
+class BumpError(Exception):
+    """Raised when a bump couldn't be done. Nothing is left changed"""
+
+
+BumpStage = namedtuple(
+    "BumpStage",
+    ["module", "staging_dir", "version_dir", "metadata_path", "old_metadata"],
+)
+
+
+def bump_versions(registry_index, new_versions):
+    """
+    Create a new version folder for each module, all or nothing.
+
+    Each new version folder starts as a copy of the module's newest. MODULE.bazel gets the new
+    version, the new version of any bumped bazel_deps, and for a new Boost release, the new
+    compatibility_level. For a new Boost release, source.json also gets the release's url,
+    strip_prefix and integrity, which means downloading the archive (into the archive cache, ready
+    for setup). Everything else is linked, as it hasn't changed, and the version is added to
+    metadata.json.
+
+    Every module is prepared in a hidden staging folder, across a pool of workers, and only once
+    they've all succeeded are they moved into place. If anything fails, everything is removed
+    again.
+
+    :param new_versions: A dict of module name -> the version to bump it to.
+    :return: The new version folders.
+    :raises BumpError: If any module couldn't be bumped, in which case none are.
+    """
+    results = run_multithreaded_tasks(
+        list(new_versions),
+        stage_version_bump,
+        get_download_workers(),
+        "Bumping",
+        registry_index,
+        new_versions,
+    )
+    stages = [result.result for result in results if not result.error]
+    errors = [f"{result.item}: {result.error}" for result in results if result.error]
+    if errors:
+        for stage in stages:
+            shutil.rmtree(stage.staging_dir, ignore_errors=True)
+            os.remove(stage.metadata_path + ".bump")
+        raise BumpError("; ".join(errors))
+
+    # Move everything into place, putting it all back if anything goes wrong
+    committed = []
+    try:
+        for stage in stages:
+            os.rename(stage.staging_dir, stage.version_dir)
+            committed.append(stage)
+            os.replace(stage.metadata_path + ".bump", stage.metadata_path)
+    except OSError as e:
+        for stage in stages:
+            if stage in committed:
+                shutil.rmtree(stage.version_dir, ignore_errors=True)
+                with open(stage.metadata_path, "wb") as f:
+                    f.write(stage.old_metadata)
+            else:
+                shutil.rmtree(stage.staging_dir, ignore_errors=True)
+            if os.path.exists(stage.metadata_path + ".bump"):
+                os.remove(stage.metadata_path + ".bump")
+        raise BumpError(f"Couldn't move the new version folders into place: {e}")
+    finally:
+        for module in new_versions:
+            registry_index.invalidate(module)
+
+    return [stage.version_dir for stage in stages]
+
+
+def stage_version_bump(module, registry_index, new_versions):
+    """Prepare a module's new version folder and metadata.json for bump_versions, as a BumpStage"""
+    info = registry_index[module]
+    old_version_dir = info.newest_version_dir
+    if not old_version_dir:
+        raise BumpError("It has no version to bump from")
+    new_version = new_versions[module]
+    version_dir = os.path.join(info.dir, new_version)
+    if os.path.exists(version_dir):
+        raise BumpError(f"{new_version} already exists")
+    if version_key(new_version) <= version_key(os.path.basename(old_version_dir)):
+        raise BumpError(
+            f"{new_version} isn't newer than {os.path.basename(old_version_dir)}"
+        )
+
+    # Hidden, so nothing takes it for a version folder before it's finished
+    staging_dir = os.path.join(info.dir, f".{new_version}.bump")
+    shutil.rmtree(staging_dir, ignore_errors=True)
+    shutil.copytree(
+        old_version_dir,
+        staging_dir,
+        # presubmit.yml is there for maintainers to edit, so it gets its own copy
+        copy_function=lambda src, dst: link_or_copy(
+            src, dst, hardlink=os.path.basename(src) != "presubmit.yml"
+        ),
+    )
+    try:
+        old_release = get_boost_release(os.path.basename(old_version_dir))
+        new_release = get_boost_release(new_version)
+
+        # A new Boost release means a new archive
+        source_json_path = os.path.join(staging_dir, module_source_file_name)
+        source_json, indent = load_json_file(source_json_path)
+        if new_release != old_release:
+            for key in ("url", "strip_prefix"):
+                if key in source_json:
+                    source_json[key] = source_json[key].replace(
+                        old_release, new_release
+                    )
+            source_json["integrity"] = fetch_integrity(source_json["url"])
+        write_json_atomically(source_json_path, source_json, indent)
+
+        module_bazel_path = os.path.join(staging_dir, "MODULE.bazel")
+        with open(module_bazel_path, "r") as f:
+            module_bazel = f.read()
+        os.remove(module_bazel_path)  # It's a link to the old version's
+        with open(module_bazel_path, "w") as f:
+            f.write(
+                bump_module_bazel(module_bazel, new_version, new_versions, old_release)
+            )
+
+        metadata_path = os.path.join(info.dir, "metadata.json")
+        with open(metadata_path, "rb") as f:
+            old_metadata = f.read()
+        metadata, indent = load_json_file(metadata_path)
+        metadata["versions"] = sorted(
+            set(metadata.get("versions", [])) | {new_version}, key=version_key
+        )
+        write_json_atomically(metadata_path + ".bump", metadata, indent)
+    except BaseException:
+        shutil.rmtree(staging_dir, ignore_errors=True)
+        raise
+
+    return BumpStage(module, staging_dir, version_dir, metadata_path, old_metadata)
+
+
+def bump_module_bazel(text, new_version, new_versions, old_release):
+    """
+    Rewrite a MODULE.bazel for a bump: the module's version, the bazel_deps on other modules being
+    bumped, and the compatibility_level if this is a new Boost release.
+    """
+    new_release = get_boost_release(new_version)
+
+    def bump_module_call(match):
+        module_call = re.sub(
+            r'(\bversion = ")[^"]*(")',
+            lambda version: version.group(1) + new_version + version.group(2),
+            match.group(0),
+            count=1,
+        )
+        if new_release != old_release:
+            # Boost's compatibility_level follows its version, e.g. 108300 for 1.83.0. Any other
+            # numbering just goes up by one
+            module_call = re.sub(
+                r"(\bcompatibility_level = )(\d+)",
+                lambda level: level.group(1)
+                + str(
+                    get_compatibility_level(new_release)
+                    if int(level.group(2)) == get_compatibility_level(old_release)
+                    else int(level.group(2)) + 1
+                ),
+                module_call,
+                count=1,
+            )
+        return module_call
+
+    text = re.sub(
+        r"^module\((?:[^()]|\([^()]*\))*\)",
+        bump_module_call,
+        text,
+        count=1,
+        flags=re.MULTILINE,
+    )
+    return boost_bazel_dep_pattern.sub(
+        lambda dep: (
+            f'bazel_dep(name = "{dep.group(1)}", version = "{new_versions[dep.group(1)]}")\n'
+            if dep.group(1) in new_versions
+            else dep.group(0)
+        ),
+        text,
+    )
+
+
+def get_boost_release(version):
+    """Get the Boost release a registry version is of, e.g. 1.83.0 for 1.83.0.bcr.1"""
+    return ".".join(version.split(".")[:3])
+
+
+def get_next_registry_version(version):
+    """Get the next registry version of the same Boost release, e.g. 1.83.0.bcr.2 after 1.83.0.bcr.1"""
+    release = get_boost_release(version)
+    if version == release:
+        return f"{release}.bcr.1"
+    return f"{release}.bcr.{version_key(version)[-1] + 1}"
+
+
+def get_compatibility_level(release):
+    """Get the compatibility_level Boost modules use for a release, e.g. 108300 for 1.83.0"""
+    major, minor, patch = (int(part) for part in release.split("."))
+    return major * 100000 + minor * 100 + patch
+
+
+def fetch_integrity(url):
+    """Download an archive into the archive cache, returning its integrity"""
+    if offline_mode:
+        raise RuntimeError(f"Offline, so {url} can't be downloaded")
+
+    os.makedirs(archive_cache_dir, exist_ok=True)
+    temp_path = os.path.join(
+        archive_cache_dir, f"{threading.get_ident()}.download"
+    )  # Not ending in .tar.gz, so it isn't evicted while downloading
+    if not download(url, temp_path):
+        raise RuntimeError(f"Couldn't download {url}")
+
+    integrity = file_integrity(temp_path)
+    add_to_archive_cache(temp_path, integrity)
+    os.remove(temp_path)
+    return integrity
+
+
+def copy_module_bazel_to_sources(registry_index, modules):
+    """
+    Copy each module's MODULE.bazel from its newest version folder into its source, e.g. after a
+    bump, so that its next patch carries it
+    """
+    for module in modules:
+        info = registry_index[module]
+        if info.source_dir and os.path.isdir(info.source_dir):
+            shutil.copyfile(
+                os.path.join(info.newest_version_dir, "MODULE.bazel"),
+                os.path.join(info.source_dir, "MODULE.bazel"),
+            )
+
+
+def bump_boost(
+    registry_dir, registry_index, registry_state, boost_version, modules=None
+):
+    """
+    Bump modules to a new Boost release, set their new sources up, make their dependencies match
+    what their sources include, and patch them.
+
+    :param boost_version: The Boost release to bump to, e.g. 1.86.0.
+    :param modules: The names of the modules to bump. Defaults to every module on an older release.
+    :return: (the modules bumped, a list of {"module", "error"} for every module that didn't set up
+        or patch, the test changes of every bumped module as from diff_test_files)
+    :raises BumpError: If any module couldn't be bumped, in which case none are.
+    :raises ValueError: If boost_version isn't a Boost release version.
+    """
+    if not re.fullmatch(r"\d+\.\d+\.\d+", boost_version):
+        raise ValueError(f"{boost_version} isn't a Boost version, e.g. 1.86.0")
+    if modules is None:
+        modules = [
+            module
+            for module in registry_index.names()
+            if registry_index[module].newest_version_dir
+            and version_key(
+                get_boost_release(
+                    os.path.basename(registry_index[module].newest_version_dir)
+                )
+            )
+            < version_key(boost_version)
+        ]
+    if not modules:
+        return [], [], {}
+
+    bump_versions(registry_index, {module: boost_version for module in modules})
+
+    # The new sources start from the old patches. Their MODULE.bazel and dependencies are then
+    # brought up to date, for the new patches to carry
+    version_dirs, setup_failures = setup_sources(
+        registry_dir, registry_index, registry_state, modules
+    )
+    failures = [
+        {"module": registry_index.module_of(version), "error": str(error)}
+        for version, _, error in setup_failures
+    ]
+    failed_modules = {failure["module"] for failure in failures}
+    ready_modules = [
+        module
+        for module in modules
+        if module not in failed_modules
+        and registry_index[module].source_dir
+        and os.path.isdir(registry_index[module].source_dir)
+    ]
+    copy_module_bazel_to_sources(registry_index, ready_modules)
+    dependencies = calculate_dependencies(registry_dir, registry_index)
+    update_dependencies(
+        registry_index,
+        {
+            module: module_dependencies
+            for module, module_dependencies in dependencies.items()
+            if module in ready_modules
+        },
+    )
+
+    results = patch_and_hash(
+        registry_dir,
+        [registry_index[module].source_dir for module in ready_modules],
+        registry_state,
+        registry_index,
+    )
+    failures += [
+        {"module": registry_index.module_of(result.item), "error": str(result.error)}
+        for result in results
+        if result.error
+    ]
+
+    test_diffs, test_failures = diff_test_files(registry_index, modules)
+    failures += [
+        {"module": module, "error": error} for module, error in test_failures.items()
+    ]
+    return modules, failures, test_diffs
+
+
+def get_base_versions(registry_dir, base_git_commit_hash, boost_lib_dirs):
+    """Get the version folder names each module had in the base commit, as a dict of name -> set"""
+    base_versions = {os.path.basename(lib): set() for lib in boost_lib_dirs}
+    if not boost_lib_dirs:
+        return base_versions
+
+    result = subprocess.run(
+        ["git", "ls-tree", "-d", base_git_commit_hash, "--"]
+        + [
+            os.path.relpath(lib, registry_dir).replace(os.sep, "/") + "/"
+            for lib in boost_lib_dirs
+        ],
+        cwd=registry_dir,
+        stdout=subprocess.PIPE,
+        text=True,
+    )
+    for line in result.stdout.splitlines():
+        path = line.split("\t", 1)[1]
+        module, version = path.split("/")[-2:]
+        base_versions.setdefault(module, set()).add(version)
+
+    return base_versions
+
+
+@traced("Patching")
+def patch_and_hash(registry_dir, lib_sources, registry_state=None, registry_index=None):
+    patch_file_name = "patch.diff"
+    if registry_index is None:
+        registry_index = RegistryIndex(os.path.join(registry_dir, "modules"))
+
+    @traced("Patching module")
+    def task(lib_source, registry_dir):
+        module = registry_index.module_of(lib_source)
+        newest_version = registry_index[module].newest_version_dir
+        patches_folder = os.path.join(
+            newest_version,
+            "patches",
+        )
+        diff_file = os.path.join(patches_folder, patch_file_name)
+
+        subprocess.run(
+            ["git", "add", "."],
+            cwd=lib_source,
+        )
+
+        # Stream the git diff to disk, hashing it on the way through
+        temp_diff_file = diff_file + ".tmp"
+        integrity = write_staged_diff(lib_source, temp_diff_file)
+
+        # Update module_source_file_name with the new patch information
+        source_json_path = os.path.join(
+            os.path.dirname(patches_folder), module_source_file_name
+        )
+
+        with open(source_json_path, "r") as f:
+            data = json.load(f)
+
+        patches = {patch_file_name: integrity}
+        if data.get("patches") == patches and os.path.exists(diff_file):
+            # Same patch as before, so leave both files (and their mtimes) alone
+            os.remove(temp_diff_file)
+        else:
+            os.replace(temp_diff_file, diff_file)
+            data["patches"] = patches
+            write_json_atomically(source_json_path, data)
+            registry_index.invalidate(module)
+
+        # Remember the patch, and that source.json changing here doesn't need a new setup
+        if registry_state:
+            registry_state.update(
+                newest_version,
+                patch=integrity,
+                source_json_mtime=os.stat(source_json_path).st_mtime_ns,
+            )
+
+        # Copy the MODULE.bazel file to the version folder, replacing rather than overwriting it
+        src = os.path.join(lib_source, "MODULE.bazel")
+        dst = os.path.join(newest_version, os.path.basename(src))
+        shutil.copy(src, dst + ".tmp")
+        os.replace(dst + ".tmp", dst)
+
+    return run_multithreaded_tasks(
+        lib_sources,
+        task,
+        None,
+        "Patching",
+        registry_dir,
+    )
+
+
+def write_staged_diff(repo_dir, diff_file=None, env=None):
+    """
+    Write the staged git diff of a repo to diff_file (if given), returning its SRI string. env can
+    point git at another index with GIT_INDEX_FILE.
+    """
+    hasher = hashlib.sha256()
+    with open(diff_file or os.devnull, "wb") as f, subprocess.Popen(
+        ["git", "diff", "--cached"],
+        cwd=repo_dir,
+        env=env,
+        stdout=subprocess.PIPE,
+    ) as process:
+        for chunk in hash_chunks(
+            iter(lambda: process.stdout.read(download_chunk_size), b""), hasher
+        ):
+            f.write(chunk)
+
+    if process.returncode:
+        if diff_file:
+            os.remove(diff_file)
+        raise subprocess.CalledProcessError(process.returncode, process.args)
+    return make_integrity(hasher)
+
+
+def write_json_atomically(path, data, indent=2):
+    """Write data as JSON via a temp file, so readers never see a half written file"""
+    temp_path = path + ".tmp"
+    with open(temp_path, "w") as f:
+        json.dump(data, f, indent=indent)
+        f.write("\n")
+    os.replace(temp_path, path)
+
+
+def load_json_file(path):
+    """Read a JSON file, along with its indent so it can be written back the same way"""
+    with open(path, "r") as f:
+        text = f.read()
+    indent = re.search(r'^( +)"', text, re.MULTILINE)
+    return json.loads(text), len(indent.group(1)) if indent else 2
+
+
+VerifyResult = namedtuple("VerifyResult", ["module", "version", "problems"])
+
+
+def verify_patches(registry_index, modules=None):
+    """
+    Check each module's newest version folder against its archive, like the registry's checks do:
+    that the archive and patches match their integrity in source.json, that the patches apply
+    cleanly, and that the patched MODULE.bazel is the version folder's MODULE.bazel.
+
+    Archives not in the archive cache are downloaded into it first, then the modules are checked
+    across a pool of processes.
+
+    :param modules: The names of the modules to check. Defaults to all of them.
+    :return: A VerifyResult(module, version, problems) per module, with problems a dict of check
+        name to what's wrong. It's empty if the module passed.
+    """
+    version_dirs = registry_index.newest_version_dirs(modules)
+    results = {}
+
+    downloads = run_multithreaded_tasks(
+        version_dirs, cache_archive, get_download_workers(), "Downloading"
+    )
+    pending = []
+    for download in downloads:
+        if download.error:
+            results[download.item] = {"archive": str(download.error)}
+        else:
+            pending.append(download)
+
+    if pending:
+        from concurrent.futures import ProcessPoolExecutor
+
+        with ProcessPoolExecutor(
+            max_workers=min(local_threads, len(pending))
+        ) as executor, progress_bar() as pb:
+            pb.title = progress_title("Verifying patches")
+            futures = {
+                executor.submit(
+                    verify_version, download.item, download.result, verify_scratch_dir
+                ): download.item
+                for download in pending
+            }
+            for future in pb(as_completed(futures), total=len(futures)):
+                try:
+                    results[futures[future]] = future.result()
+                except Exception as e:
+                    results[futures[future]] = {"error": str(e)}
+
+    return [
+        VerifyResult(
+            registry_index.module_of(version),
+            os.path.basename(version),
+            results[version],
+        )
+        for version in version_dirs
+    ]
+
+
+@traced("Downloading")
+def cache_archive(boost_lib_version):
+    """Make sure a version folder's archive is in the archive cache, returning its path there"""
+    source_json = load_source_json(boost_lib_version)
+    url = source_json.get("url")
+    integrity = source_json.get("integrity")
+    if not integrity:
+        raise ValueError(f"{module_source_file_name} has no integrity")
+
+    cached_path = cached_archive_path(integrity)
+    if os.path.exists(cached_path):
+        return cached_path
+    if offline_mode:
+        raise RuntimeError(f"Offline and {url} isn't in the archive cache")
+
+    # Downloaded next to the cache, so adding it is a hard link
+    os.makedirs(archive_cache_dir, exist_ok=True)
+    temp_path = f"{cached_path}.{threading.get_ident()}.download"
+    if not download(url, temp_path, integrity):
+        raise RuntimeError(
+            f"Couldn't download {url}, or it doesn't match its integrity"
+        )
+
+    add_to_archive_cache(temp_path, integrity)
+    os.remove(temp_path)
+    return cached_path
+
+
+def verify_version(boost_lib_version, tar_path, scratch_dir=None):
+    """
+    Check a version folder against its archive, see verify_patches. This runs in a worker process.
+
+    Only the files the patches touch are extracted, into a temporary folder in scratch_dir, so
+    checking a big archive costs little more than decompressing it.
+
+    :return: A dict of check name to what's wrong, for every check that failed.
+    """
+    import tempfile
+
+    source_json = load_source_json(boost_lib_version)
+    problems = {}
+
+    integrity = source_json.get("integrity")
+    actual_integrity = file_integrity(tar_path, parse_integrity(integrity)[0])
+    if actual_integrity != integrity:
+        problems["archive"] = f"The archive's integrity is {actual_integrity}"
+
+    patches = source_json.get("patches", {})
+    # Absolute, as git apply runs in the scratch source
+    patch_paths = [
+        os.path.abspath(os.path.join(boost_lib_version, "patches", name))
+        for name in patches
+    ]
+    for (name, patch_integrity), patch_path in zip(patches.items(), patch_paths):
+        if not os.path.exists(patch_path):
+            problems.setdefault("patches", []).append(f"{name} is missing")
+        elif file_integrity(patch_path, parse_integrity(patch_integrity)[0]) != (
+            patch_integrity
+        ):
+            problems.setdefault("patches", []).append(
+                f"{name} doesn't match its integrity"
+            )
+    if "patches" in problems:
+        problems["patches"] = ", ".join(problems["patches"])
+        return problems
+
+    with tempfile.TemporaryDirectory(
+        prefix="super_tool_verify_", dir=scratch_dir
+    ) as temp_dir:
+        source = os.path.join(temp_dir, "source")
+        os.mkdir(source)
+
+        # Stop git finding a repository above the scratch folder and applying relative to that
+        git_env = dict(os.environ, GIT_CEILING_DIRECTORIES=temp_dir)
+        strip = f"-p{source_json.get('patch_strip', 0)}"
+
+        def git_apply(*args):
+            return subprocess.run(
+                ["git", "apply", strip, "--whitespace=nowarn", *args],
+                cwd=source,
+                env=git_env,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                text=True,
+            )
+
+        touched_paths = {"MODULE.bazel"}
+        for patch_path in patch_paths:
+            touched_paths.update(
+                get_patched_paths(git_apply("--numstat", "-z", patch_path).stdout)
+            )
+        extract_members(
+            tar_path, source_json.get("strip_prefix", ""), touched_paths, source
+        )
+
+        # The patches are applied in order, each one being checked before anything is changed
+        for name, patch_path in zip(patches, patch_paths):
+            result = git_apply(patch_path)
+            if result.returncode:
+                problems["applies"] = f"{name}: {result.stderr.strip()}"
+                return problems
+
+        module_bazel = os.path.join(boost_lib_version, "MODULE.bazel")
+        patched_module_bazel = os.path.join(source, "MODULE.bazel")
+        if not os.path.exists(patched_module_bazel):
+            problems["MODULE.bazel"] = "The patched source has no MODULE.bazel"
+        elif not os.path.exists(module_bazel):
+            problems["MODULE.bazel"] = "The version folder has no MODULE.bazel"
+        else:
+            with open(module_bazel, "rb") as a, open(patched_module_bazel, "rb") as b:
+                if a.read() != b.read():
+                    problems["MODULE.bazel"] = (
+                        "The version folder's MODULE.bazel isn't the patched one"
+                    )
+
+    return problems
+
+
+def get_patched_paths(numstat):
+    """Get every path in the output of git apply --numstat -z, including both sides of renames"""
+    paths = set()
+    fields = iter(numstat.split("\0"))
+    for field in fields:
+        if not field:
+            continue
+        path = field.split("\t", 2)[2]
+        if path:
+            paths.add(path)
+        else:
+            paths.update([next(fields), next(fields)])  # A rename, as from and to
+    return paths
+
+
+def extract_members(tar_path, strip_prefix, paths, extract_dir):
+    """Extract only the given paths (relative to strip_prefix) from an archive, in one pass"""
+    import tarfile
+
+    prefix = f"{strip_prefix}/" if strip_prefix else ""
+    with tarfile.open(tar_path, mode="r|*") as tar:
+        for member in tar:
+            if member.name.startswith(prefix) and member.name[len(prefix) :] in paths:
+                member.name = member.name[len(prefix) :]
+                tar.extract(member, extract_dir)
+
+
+def format_verify_report(results):
+    """Format verify_patches results as a pass or fail line per module"""
+    lines = []
+    for result in results:
+        lines.append(
+            f"{'FAIL' if result.problems else 'PASS'}  {result.module} {result.version}"
+        )
+        for check, problem in result.problems.items():
+            problem = problem.replace("\n", "\n        ")
+            lines.append(f"      {check}: {problem}")
+    failed = sum(1 for result in results if result.problems)
+    lines.append(f"{len(results) - failed} passed, {failed} failed")
+    return "\n".join(lines)
+
+
+jam_negative_test_pattern = re.compile(
+    r"\b(?:compile|link|run)-fail\s+([^\s\]]+?)\.cpp\b"
+)  # e.g. [ compile-fail test_foo_fail.cpp ] in a test Jamfile
+
+
+def diff_test_files(registry_index, modules=None, old_version=None, new_version=None):
+    """
+    Find the test files each module added, deleted and changed between two of its versions, e.g.
+    to update its test BUILD files after a Boost version bump.
+
+    The test folders are compared straight from the archives, which come from the archive cache or
+    are downloaded into it. Tests are split into positive and negative as boost_test_set in
+    tools.bzl expects, with negative tests being those the test Jamfiles expect to fail.
+
+    :param modules: The names of the modules to compare. Defaults to all of them.
+    :param old_version: The version to compare from. Defaults to each module's second newest.
+    :param new_version: The version to compare to. Defaults to each module's newest.
+    :return: (diffs, failures). diffs is a dict of module name to a dict with the "old_version"
+        and "new_version" compared, and the "new", "deleted" and "modified" test files as from
+        group_test_files. Modules without both versions are left out. failures is a dict of
+        module name to error message.
+    """
+    if modules is None:
+        modules = registry_index.names()
+
+    comparisons = {}
+    skipped = []
+    for module in modules:
+        info = registry_index[module]
+        new = new_version or (info.versions[-1] if info.versions else None)
+        old = old_version or (info.versions[-2] if len(info.versions) > 1 else None)
+        if old in info.versions and new in info.versions and old != new:
+            comparisons[module] = (
+                os.path.join(info.dir, old),
+                os.path.join(info.dir, new),
+            )
+        else:
+            skipped.append(module)
+    if skipped and (old_version or new_version):
+        logging.warning(
+            f"Skipping {', '.join(skipped)}, which don't have both versions to compare"
+        )
+
+    version_dirs = [version for pair in comparisons.values() for version in pair]
+    downloads = run_multithreaded_tasks(
+        version_dirs, cache_archive, get_download_workers(), "Downloading"
+    )
+    archives = {download.item: download for download in downloads}
+
+    # Read the archives across a pool of processes, as decompressing them is the slow part
+    manifests = {}
+    failures = {}
+    pending = [download for download in downloads if not download.error]
+    if pending:
+        from concurrent.futures import ProcessPoolExecutor
+
+        with ProcessPoolExecutor(
+            max_workers=min(local_threads, len(pending))
+        ) as executor, progress_bar() as pb:
+            pb.title = progress_title("Reading tests")
+            futures = {
+                executor.submit(
+                    build_test_manifest,
+                    download.result,
+                    load_source_json(download.item).get("strip_prefix", ""),
+                ): download.item
+                for download in pending
+            }
+            for future in pb(as_completed(futures), total=len(futures)):
+                try:
+                    manifests[futures[future]] = future.result()
+                except Exception as e:
+                    failures[registry_index.module_of(futures[future])] = str(e)
+
+    diffs = {}
+    for module, (old, new) in comparisons.items():
+        for version in (old, new):
+            if archives[version].error:
+                failures[module] = str(archives[version].error)
+        if module in failures:
+            continue
+
+        (old_files, old_negative), (new_files, new_negative) = (
+            manifests[old],
+            manifests[new],
+        )
+        old_paths, new_paths = set(old_files), set(new_files)
+        diffs[module] = {
+            "old_version": os.path.basename(old),
+            "new_version": os.path.basename(new),
+            "new": group_test_files(new_paths - old_paths, new_negative),
+            "deleted": group_test_files(old_paths - new_paths, old_negative),
+            "modified": group_test_files(
+                {
+                    path
+                    for path in old_paths & new_paths
+                    if old_files[path] != new_files[path]
+                },
+                new_negative,
+            ),
+        }
+
+    return diffs, failures
+
+
+def build_test_manifest(tar_path, strip_prefix):
+    """
+    Hash every file in an archive's test folder, reading it as a stream rather than extracting it.
+    This runs in a worker process.
+
+    :return: (a dict of path within the test folder to content hash, the names of the negative
+        tests, also relative to the test folder)
+    """
+    import tarfile
+
+    prefix = f"{strip_prefix}/test/" if strip_prefix else "test/"
+    files = {}
+    negative_names = set()
+    with tarfile.open(tar_path, mode="r|*") as tar:
+        for member in tar:
+            if not member.isfile() or not member.name.startswith(prefix):
+                continue
+            path = member.name[len(prefix) :]
+            content = tar.extractfile(member).read()
+            files[path] = hashlib.blake2b(content, digest_size=16).hexdigest()
+
+            # Jamfiles name the tests meant to fail, relative to their own folder
+            folder, _, name = path.rpartition("/")
+            if name.startswith("Jamfile"):
+                for match in jam_negative_test_pattern.finditer(
+                    content.decode("utf-8", "replace")
+                ):
+                    negative_names.add(
+                        f"{folder}/{match.group(1)}" if folder else match.group(1)
+                    )
+
+    return files, negative_names
+
+
+def group_test_files(paths, negative_names):
+    """
+    Split test folder paths into the positive_test_names and negative_test_names that
+    boost_test_set takes, plus other_files for everything that isn't a test source.
+    """
+    groups = {"positive_test_names": [], "negative_test_names": [], "other_files": []}
+    for path in sorted(paths):
+        if not path.endswith(".cpp"):
+            groups["other_files"].append(path)
+        elif path[: -len(".cpp")] in negative_names:
+            groups["negative_test_names"].append(path[: -len(".cpp")])
+        else:
+            groups["positive_test_names"].append(path[: -len(".cpp")])
+    return groups
+
+
+def format_test_diff(diffs):
+    """Format diff_test_files results per module, with test names ready for boost_test_set"""
+    lines = []
+    unchanged = 0
+    for module, diff in diffs.items():
+        changes = [
+            change
+            for change in ("new", "deleted", "modified")
+            if any(diff[change].values())
+        ]
+        if not changes:
+            unchanged += 1
+            continue
+
+        lines.append(f"{module} {diff['old_version']} -> {diff['new_version']}")
+        for change in changes:
+            lines.append(f"    {change.capitalize()}:")
+            for key, names in diff[change].items():
+                if not names:
+                    continue
+                if key == "other_files":
+                    lines.append(f"        # Other files: {', '.join(names)}")
+                else:
+                    lines.append(
+                        f"        {key} = [{', '.join(json.dumps(name) for name in names)}],"
+                    )
+    lines.append(
+        f"{len(diffs) - unchanged} modules with test changes, {unchanged} without"
+    )
+    return "\n".join(lines)
+
+
+def tidy_up(boost_lib_dirs, registry_state=None, wait=True):
+    """
+    Delete the diffed_sources folder of each module.
+
+    Each folder is renamed into a trash folder first, which is instant, so the registry is clean as
+    soon as that's done. The trash is then deleted in parallel, either before returning or in the
+    background. Anything left in the trash by an earlier run that was cut short goes too.
+
+    :param boost_lib_dirs: The module folders to clean.
+    :param registry_state: The RegistryState to forget the modules in.
+    :param wait: Delete the trash before returning, rather than in a background thread.
+    :return: The number of bytes freed, or None if the trash is being deleted in the background.
+    """
+    if not boost_lib_dirs:
+        return 0
+    trash_dir = get_trash_dir(os.path.dirname(boost_lib_dirs[0]))
+
+    for lib in boost_lib_dirs:
+        diffed_sources_dir = os.path.join(lib, "diffed_sources")
+        if os.path.exists(diffed_sources_dir):
+            os.makedirs(trash_dir, exist_ok=True)
+            os.rename(
+                diffed_sources_dir,
+                os.path.join(trash_dir, f"{os.path.basename(lib)}-{time.time_ns()}"),
+            )
+        if registry_state:
+            registry_state.forget(os.path.basename(lib))
+
+    if wait:
+        return empty_trash(trash_dir)
+
+    # Not a daemon, so exiting waits for it rather than leaving a half deleted tree
+    threading.Thread(
+        target=empty_trash, args=(trash_dir, False), name="empty_trash"
+    ).start()
+    return None
+
+
+def get_trash_dir(modules_dir):
+    """Get the folder sources are moved to before they're deleted, out of git's sight"""
+    git_dir = os.path.join(os.path.dirname(modules_dir), ".git")
+    if os.path.isdir(git_dir):
+        return os.path.join(git_dir, "super_tool_trash")
+    return os.path.join(modules_dir, ".super_tool_trash")
+
+
+def empty_trash(trash_dir, show_progress=True):
+    """Delete everything in the trash folder in parallel, returning the number of bytes freed"""
+    if not os.path.isdir(trash_dir):
+        return 0
+    trees = [os.path.join(trash_dir, name) for name in os.listdir(trash_dir)]
+
+    if show_progress:
+        freed = sum(
+            result.result or 0
+            for result in run_multithreaded_tasks(trees, delete_tree, None, "Deleting")
+        )
+    else:
+        with ThreadPoolExecutor(max_workers=local_threads) as executor:
+            freed = sum(executor.map(delete_tree, trees))
+
+    try:
+        os.rmdir(trash_dir)
+    except OSError:
+        pass  # Something else was put in the trash meanwhile, the next clean will get it
+    return freed
+
+
+def delete_tree(path):
+    """
+    Delete a folder, returning the number of bytes of disk freed. Files hard linked elsewhere, like
+    archives shared with the archive cache, don't free anything so aren't counted.
+    """
+    freed = 0
+    failures = 0
+
+    def remove(remove_func, entry_path):
+        nonlocal failures
+        try:
+            remove_func(entry_path)
+        except PermissionError:
+            # Read only files can't be deleted on Windows, which git's objects are
+            try:
+                os.chmod(entry_path, stat.S_IWRITE)
+                remove_func(entry_path)
+            except OSError:
+                failures += 1
+        except OSError:
+            failures += 1
+
+    for dir_path, dir_names, file_names in os.walk(path, topdown=False):
+        for name in file_names:
+            file_path = os.path.join(dir_path, name)
+            try:
+                file_stat = os.lstat(file_path)
+                if file_stat.st_nlink <= 1:
+                    freed += (
+                        getattr(file_stat, "st_blocks", 0) * 512 or file_stat.st_size
+                    )
+            except OSError:
+                pass
+            remove(os.unlink, file_path)
+        for name in dir_names:
+            dir_entry = os.path.join(dir_path, name)
+            remove(os.unlink if os.path.islink(dir_entry) else os.rmdir, dir_entry)
+    remove(os.rmdir, path)
+
+    if failures:
+        logging.warning(f"Couldn't delete {failures} files or folders in {path}")
+    return freed
+
+
+def find_unpatched_sources(registry_index, modules):
+    """
+    Find which modules have changes in their source that aren't in their patch yet, and so would be
+    lost if the source was deleted.
+
+    Sources are first checked cheaply for changes, then only those with any have their changes
+    diffed and compared with the patch in source.json.
+    """
+    sources = [
+        registry_index[module].source_dir
+        for module in modules
+        if registry_index[module].source_dir
+        and os.path.isdir(registry_index[module].source_dir)
+    ]
+    results = run_multithreaded_tasks(
+        detect_changed_sources(sources),
+        source_matches_patch,
+        None,
+        "Comparing with patches",
+        registry_index,
+    )
+    return [
+        registry_index.module_of(result.item) for result in results if not result.result
+    ]
+
+
+def source_matches_patch(source, registry_index):
+    """Check whether a source's changes are exactly what its version folder's patch has"""
+    import tempfile
+
+    source_json = registry_index[registry_index.module_of(source)].source_json or {}
+
+    # Stage everything in a copy of the index, so what the user has staged is left alone
+    with tempfile.TemporaryDirectory(prefix="super_tool_index_") as temp_dir:
+        index_path = os.path.join(temp_dir, "index")
+        shutil.copyfile(os.path.join(source, ".git", "index"), index_path)
+        git_env = dict(os.environ, GIT_INDEX_FILE=index_path)
+        subprocess.run(
+            ["git", "add", "."],
+            cwd=source,
+            env=git_env,
+            check=True,
+        )
+        integrity = write_staged_diff(source, env=git_env)
+    return integrity in source_json.get("patches", {}).values()
+
+
+# Matches the Boost headers a file includes, e.g. "#include <boost/config.hpp>"
+include_directive_pattern = re.compile(
+    rb'^[ \t]*#[ \t]*include[ \t]*[<"](boost/[^>"\s]+)[>"]', re.MULTILINE
+)
+
+# Matches a plain bazel_dep on another Boost module, which is what dependency updates rewrite
+boost_bazel_dep_pattern = re.compile(
+    r'^bazel_dep\(name = "(boost\.[^"]+)", version = "[^"]*"\)\n', re.MULTILINE
+)
+
+
+def calculate_dependencies(
+    registry_dir, registry_index, header_index=None, num_processes=None
+):
+    """
+    Work out which modules each module depends on, from the Boost headers its main target includes.
+
+    Every file in each module's include/boost folder and src folder is scanned for includes, and each
+    included header is resolved to the module that provides it with the HeaderIndex. Includes found are cached by git blob
+    id in the registry's .git folder, so only files that are new or changed since the last scan (e.g.
+    in a new Boost release) are read.
+
+    :param registry_dir: The registry the modules belong to.
+    :param registry_index: The RegistryIndex of the registry.
+    :param header_index: The HeaderIndex of the registry, which is refreshed before use.
+    :param num_processes: Number of processes to scan with. Defaults to one per core.
+    :return: A dict of module name -> sorted list of the module names it depends on. Modules whose
+        source isn't set up are left out.
+    """
+    cache_path = os.path.join(registry_dir, ".git", "super_tool_include_cache.json")
+    try:
+        with open(cache_path, "r") as f:
+            cached_includes = json.load(f)["includes"]
+    except (IOError, json.JSONDecodeError, KeyError):
+        cached_includes = {}
+
+    modules = [
+        module
+        for module in registry_index.names()
+        if registry_index[module].source_dir
+        and os.path.isdir(registry_index[module].source_dir)
+    ]
+    listings = run_multithreaded_tasks(
+        [registry_index[module].source_dir for module in modules],
+        list_target_files,
+        None,
+        "Listing",
+    )
+
+    # Find the files the cache doesn't know
+    module_blobs = {}
+    unknown_files = []
+    for module, listing in zip(modules, listings):
+        module_blobs[module] = blobs = {}
+        for path, blob in listing.result or []:
+            if blob in cached_includes:
+                blobs[path] = blob
+            else:
+                unknown_files.append((module, path))
+
+    # Scan the unknown files across a pool of processes
+    batches = [
+        unknown_files[start : start + include_scan_batch_size]
+        for start in range(0, len(unknown_files), include_scan_batch_size)
+    ]
+    if batches:
+        from concurrent.futures import ProcessPoolExecutor
+
+        with ProcessPoolExecutor(
+            max_workers=min(num_processes or local_threads, len(batches))
+        ) as executor, progress_bar() as pb:
+            pb.title = progress_title("Scanning includes")
+            scans = executor.map(
+                scan_includes,
+                [
+                    [
+                        os.path.join(registry_index[module].source_dir, path)
+                        for module, path in batch
+                    ]
+                    for batch in batches
+                ],
+            )
+            for batch, results in pb(zip(batches, scans), total=len(batches)):
+                for (module, path), (blob, includes) in zip(batch, results):
+                    if blob:
+                        module_blobs[module][path] = blob
+                        cached_includes[blob] = includes
+
+    # Look each included header up once, however many modules include it
+    if header_index is None:
+        header_index = HeaderIndex(registry_dir, registry_index)
+    header_index.refresh()
+    module_includes = {
+        module: {
+            header
+            for blob in module_blobs[module].values()
+            for header in cached_includes[blob]
+        }
+        for module in modules
+    }
+    owners = {
+        header: header_index.owner(header)
+        for header in set().union(*module_includes.values())
+    }
+
+    dependencies = {}
+    for module in modules:
+        dependencies[module] = sorted(
+            {owners[header] for header in module_includes[module] if owners[header]}
+            - {module}
+        )
+
+    # Only keep what's still in use, so the cache doesn't grow with every Boost release
+    if os.path.isdir(os.path.dirname(cache_path)):
+        used_blobs = {
+            blob for blobs in module_blobs.values() for blob in blobs.values()
+        }
+        write_json_atomically(
+            cache_path,
+            {
+                "includes": {
+                    blob: includes
+                    for blob, includes in cached_includes.items()
+                    if blob in used_blobs
+                }
+            },
+        )
+
+    return dependencies
+
+
+def list_target_files(source):
+    """
+    List the files a module's main target is built from, i.e. everything under include/boost plus
+    the files directly in src. Each comes with its git blob id if git already knows its content, or
+    None if it's new or modified.
+    """
+    paths = []
+    for dir_path, _, file_names in os.walk(os.path.join(source, "include", "boost")):
+        relative_dir = os.path.relpath(dir_path, source).replace(os.sep, "/")
+        paths += [f"{relative_dir}/{name}" for name in file_names]
+    src_dir = os.path.join(source, "src")
+    if os.path.isdir(src_dir):
+        with os.scandir(src_dir) as entries:
+            paths += [f"src/{entry.name}" for entry in entries if entry.is_file()]
+
+    blobs = {}
+    if os.path.isdir(os.path.join(source, ".git")):
+        staged = subprocess.run(
+            ["git", "ls-files", "--stage", "-z", "--", "include/boost", "src"],
+            cwd=source,
+            stdout=subprocess.PIPE,
+            check=True,
+        ).stdout
+        for entry in staged.split(b"\0"):
+            if entry:
+                info, path = entry.split(b"\t", 1)
+                blobs[os.fsdecode(path)] = info.split()[1].decode()
+
+        modified = subprocess.run(
+            ["git", "diff-files", "--name-only", "-z", "--", "include/boost", "src"],
+            cwd=source,
+            stdout=subprocess.PIPE,
+            check=True,
+        ).stdout
+        for path in modified.split(b"\0"):
+            blobs.pop(os.fsdecode(path), None)
+
+    return [(path, blobs.get(path)) for path in paths]
+
+
+def scan_includes(paths):
+    """
+    Read files, returning a (git blob id, sorted included Boost headers) pair for each. Files that
+    can't be read give (None, []). This runs in worker processes, so it must stay picklable.
+    """
+    results = []
+    for path in paths:
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except OSError:
+            results.append((None, []))
+            continue
+
+        blob = hashlib.sha1(b"blob %d\0" % len(data) + data).hexdigest()
+        includes = []
+        if b"boost/" in data:
+            includes = sorted(
+                {
+                    header.decode("utf-8", "surrogateescape")
+                    for header in include_directive_pattern.findall(data)
+                }
+            )
+        results.append((blob, includes))
+    return results
+
 
-        # TODO only patch ones that have been bumped
+def update_dependencies(registry_index, dependencies):
+    """
+    Make each module's MODULE.bazel bazel_deps and main target deps match its calculated
+    dependencies. Only the source's files are changed, so the changes end up in the next patch.
 
-        # Detect what modules have changes
-        source_updated_modules = detect_changed_sources(modules_dir)
+    :param registry_index: The RegistryIndex of the registry.
+    :param dependencies: A dict of module name -> module names, as from calculate_dependencies.
+    :return: The source folders of the modules that changed.
+    """
+    updated_sources = []
+    for module, module_dependencies in dependencies.items():
+        source = registry_index[module].source_dir
+        versions = {
+            dependency: os.path.basename(registry_index[dependency].newest_version_dir)
+            for dependency in module_dependencies
+        }
 
-        if source_updated_modules:
-            choice = radiolist_dialog(
-                title=page_title,
-                text="The following modules will have their patches updated and hashed:",
-                values=[os.path.basename(module) for module in source_updated_modules],
-                ok_text="Update Patches",
-                cancel_text="Cancel",
-                style=get_custom_style(),
-            ).run()
-            if choice:
-                patch_and_hash(registry_dir, source_updated_modules)
-        else:  # No changes
-            # TODO inform of no changes
-            pass
+        module_bazel_changed = set_module_bazel_deps(
+            os.path.join(source, "MODULE.bazel"), versions
+        )
+        build_changed = set_main_target_deps(
+            os.path.join(source, "BUILD.bazel"), module, module_dependencies
+        )
+        if module_bazel_changed or build_changed:
+            updated_sources.append(source)
 
-    # if confirm:
-    #     text = input_dialog(title="Enter Text", text="Please enter some text:").run()
-    #     message_dialog(title="Entered Text", text=f"You entered: {text}").run()
-    # else:
-    #     message_dialog(title="Cancelled", text="Operation cancelled.").run()
+    return updated_sources
 
-    if choice:
-        pass
 
+def set_module_bazel_deps(module_bazel_path, versions):
+    """
+    Replace the Boost bazel_deps in a MODULE.bazel with one per module in versions, a dict of module
+    name -> version. Other bazel_deps, including boost.rules.tools and dev dependencies, are kept.
 
-def get_base_commit(
-    registry_dir,
-    upstream_remote="upstream",
-    upstream_branch="main",
-    local_branch="HEAD",
-):
-    # Check if the 'upstream' remote exists, add it if not
-    result = subprocess.run(
-        ["git", "remote"],
-        cwd=registry_dir,
-        stdout=subprocess.PIPE,
-        text=True,
+    :return: True if the file changed.
+    """
+    with open(module_bazel_path, "r") as f:
+        text = f.read()
+
+    new_lines = "".join(
+        f'bazel_dep(name = "{module}", version = "{version}")\n'
+        for module, version in versions.items()
     )
+    old_deps = [
+        match
+        for match in boost_bazel_dep_pattern.finditer(text)
+        if match.group(1) != "boost.rules.tools"
+    ]
+    if {match.group(1): match.group(0) for match in old_deps} == {
+        module: f'bazel_dep(name = "{module}", version = "{version}")\n'
+        for module, version in versions.items()
+    }:
+        return False  # Already right, even if in a different order
+    elif old_deps:
+        # Put the new lines where the first old one was
+        new_text = text[: old_deps[0].start()] + new_lines
+        for previous, match in zip(old_deps, old_deps[1:] + [None]):
+            new_text += text[previous.end() : match.start() if match else len(text)]
+    else:
+        last_dep = None
+        for last_dep in re.finditer(r"^bazel_dep\(.*\)\n", text, re.MULTILINE):
+            pass
+        if last_dep:
+            new_text = text[: last_dep.end()] + new_lines + text[last_dep.end() :]
+        else:
+            new_text = text.rstrip("\n") + "\n\n" + new_lines if new_lines else text
 
-    if "upstream" not in result.stdout.strip().split("\n"):
-        subprocess.run(
-            ["git", "remote", "add", "upstream", "https://github.com/bazelbuild/bazel-central-registry"],
-            cwd=registry_dir,
-        )
+    if new_text == text:
+        return False
+    with open(module_bazel_path, "w") as f:
+        f.write(new_text)
+    return True
 
-    # Fetch the latest information from the upstream
-    subprocess.run(
-        ["git", "fetch", upstream_remote, upstream_branch],
-        cwd=registry_dir,
-    )
 
-    # Find the last commit upstream that we based our changes on
-    base_git_commit_hash = find_git_divergence(
-        registry_dir, upstream_remote, upstream_branch, local_branch
-    )
+def set_main_target_deps(build_path, module, dependencies):
+    """
+    Set the Boost deps of a module's main target, i.e. its boost_library named after the module, to
+    the given modules. Deps on anything else are kept.
 
-    if base_git_commit_hash:
-        # Get the commit details for display to user
-        commit_details = ""
-        for key, value in get_commit_details(
-            registry_dir, base_git_commit_hash
-        ).items():
-            commit_details += f"{key}: {value}\n"
+    :return: True if the file changed.
+    """
+    with open(build_path, "r") as f:
+        text = f.read()
+
+    # Find the boost_library call for the module, falling back to the first one
+    calls = []
+    for match in re.finditer(r"^boost_library\(", text, re.MULTILINE):
+        depth = 0
+        for end in range(match.end() - 1, len(text)):
+            depth += {"(": 1, ")": -1}.get(text[end], 0)
+            if depth == 0:
+                break
+        calls.append((match.start(), end))
+    target_names = [module, module[len("boost.") :]]
+    main_call = next(
+        (
+            (start, end)
+            for start, end in calls
+            if re.search(
+                rf'^\s*name = "({"|".join(map(re.escape, target_names))})",',
+                text[start:end],
+                re.MULTILINE,
+            )
+        ),
+        calls[0] if calls else None,
+    )
+    if not main_call:
+        logging.warning(f"No boost_library found in {build_path}, deps not updated")
+        return False
+    start, end = main_call
+    call = text[start:end]
+
+    labels = [f"@{dependency}" for dependency in dependencies]
+    deps_match = re.search(r"^( *)deps = \[([^\]]*)\],\n", call, re.MULTILINE)
+    if deps_match:
+        indent = deps_match.group(1)
+        old_labels = re.findall(r'"([^"]+)"', deps_match.group(2))
+        if {label for label in old_labels if label.startswith("@boost.")} == set(
+            labels
+        ):
+            return False  # Already right, even if in a different order
+        labels = [
+            label for label in old_labels if not label.startswith("@boost.")
+        ] + labels
+    elif re.search(r"^\s*deps = ", call, re.MULTILINE):
+        logging.warning(f"deps in {build_path} isn't a plain list, deps not updated")
+        return False
+    elif not labels:
+        return False
     else:
-        base_git_commit_hash = "** No Commit Found **"
+        name_match = re.search(r"^( *)name = .*\n", call, re.MULTILINE)
+        if not name_match:
+            logging.warning(f"Can't find where to add deps in {build_path}")
+            return False
+        indent = name_match.group(1)
+
+    deps_text = f"{indent}deps = [\n"
+    deps_text += "".join(f'{indent}    "{label}",\n' for label in labels)
+    deps_text += f"{indent}],\n"
+    if deps_match:
+        call = call[: deps_match.start()] + deps_text + call[deps_match.end() :]
+    else:
+        call = call[: name_match.end()] + deps_text + call[name_match.end() :]
 
-    # Display confirmation dialogue
-    alternate_commit = input_dialog(
-        title="Verify Base Commit",
-        text=f"We detected {base_git_commit_hash} as the most recent commit in the registry prior to your changes. If you'd like to track changes that occurred after another commit, please enter it below.\n\nCommit {base_git_commit_hash}:\n{commit_details}",
-        style=get_custom_style(),
-    ).run()
+    new_text = text[:start] + call + text[end:]
+    if new_text == text:
+        return False
+    with open(build_path, "w") as f:
+        f.write(new_text)
+    return True
 
-    if alternate_commit:
-        base_git_commit_hash = alternate_commit
 
-    return base_git_commit_hash
+ModuleInfo = namedtuple(
+    "ModuleInfo",
+    ["name", "dir", "versions", "newest_version_dir", "source_json", "source_dir"],
+)
 
 
-def find_git_divergence(
-    registry_dir,
-    upstream_remote="upstream",
-    upstream_branch="main",
-    local_branch="HEAD",
-):
-    # Get upstream commits
-    result = subprocess.run(
-        [
-            "git",
-            "log",
-            "--oneline",
-            f"{upstream_remote}/{upstream_branch}",
-        ],
-        cwd=registry_dir,
-        stdout=subprocess.PIPE,
-        text=True,
-    )
-    upstream_commits = [
-        commit.split(" ")[0] for commit in result.stdout.strip().split("\n")
-    ]
+class RegistryIndex:
+    """
+    Every Boost module in the registry, looked up by name.
 
-    # Get local commits
-    result = subprocess.run(
-        [
-            "git",
-            "log",
-            "--oneline",
-            f"{upstream_remote}/{upstream_branch}..{local_branch}",
-        ],
-        cwd=registry_dir,
-        stdout=subprocess.PIPE,
-        text=True,
-    )
-    local_commits = [
-        commit.split(" ")[0] for commit in result.stdout.strip().split("\n")
-    ]
+    For each module this holds a ModuleInfo with its version folder names (oldest first), newest
+    version folder, that version's source.json and the folder its source is extracted to. Nothing is
+    read until it's needed. The module folders are listed on first use, and each module's folder and
+    source.json are only read the first time it's looked up, then remembered. Anything that changes
+    a module's version folders or source.json must call invalidate afterwards.
+    """
 
-    # Scenario 1: Most recent commit in main(upstream) with a parent from your branch
-    for commit in upstream_commits:
-        commit_hash = commit.split()[0]
-        parents = (
-            subprocess.run(
-                ["git", "log", "--pretty=%p", "-n", "1", commit_hash],
-                cwd=registry_dir,
-                stdout=subprocess.PIPE,
-                text=True,
-            )
-            .stdout.strip()
-            .split()
+    def __init__(self, modules_dir):
+        self.modules_dir = modules_dir
+        self.lock = threading.Lock()
+        self.module_names = None
+        self.modules = {}
+
+    def scan_module(self, lib):
+        """Read a module folder into a ModuleInfo"""
+        versions = sorted(
+            (
+                entry.name
+                for entry in os.scandir(lib)
+                if entry.is_dir() and entry.name.startswith("1.")
+            ),
+            key=version_key,
         )
-        for parent in parents:
-            if parent in local_commits:
-                return commit_hash
-
-    # Scenario 2: Oldest commit of your local branch with a parent in main(upstream)
-    for commit in reversed(local_commits):  # Start from the oldest
-        commit_hash = commit.split()[0]
-        parents = (
-            subprocess.run(
-                ["git", "log", "--pretty=%p", "-n", "1", commit_hash],
-                cwd=registry_dir,
-                stdout=subprocess.PIPE,
-                text=True,
-            )
-            .stdout.strip()
-            .split()
+        newest_version_dir = source_json = source_dir = None
+
+        if versions:
+            newest_version_dir = os.path.join(lib, versions[-1])
+            try:
+                source_json = load_source_json(newest_version_dir)
+                source_dir = os.path.join(
+                    lib, "diffed_sources", source_json.get("strip_prefix", "")
+                )
+            except (IOError, json.JSONDecodeError) as e:
+                logging.error(
+                    f"Error reading {module_source_file_name} for {newest_version_dir}: {e}"
+                )
+        else:
+            logging.error(f"No versions found in {lib}")
+
+        return ModuleInfo(
+            os.path.basename(lib),
+            lib,
+            versions,
+            newest_version_dir,
+            source_json,
+            source_dir,
         )
-        for parent in parents:
-            if parent in upstream_commits:
-                return parent
-
 
-def get_commit_details(registry_dir, commit_hash):
-    commands = {
-        "Author": ["git", "show", "-s", "--format=%an", commit_hash],
-        "Date": ["git", "show", "-s", "--format=%ad", commit_hash],
-        "Message": ["git", "show", "-s", "--format=%B", commit_hash],
-    }
-    details = {}
-    for key, command in commands.items():
-        result = subprocess.run(
-            command,
-            cwd=registry_dir,
-            stdout=subprocess.PIPE,
-            text=True,
+    def __getitem__(self, module):
+        info = self.modules.get(module)
+        if info is None:
+            if module not in self:
+                raise KeyError(module)
+            info = self.scan_module(os.path.join(self.modules_dir, module))
+            with self.lock:
+                info = self.modules.setdefault(module, info)
+        return info
+
+    def __contains__(self, module):
+        if self.module_names is None:
+            self.names()
+        return module in self.module_names
+
+    def names(self):
+        """The names of the modules, which only needs their folders listing"""
+        if self.module_names is None:
+            self.module_names = {
+                os.path.basename(lib): None
+                for lib in find_boost_lib_dirs(self.modules_dir)
+            }
+        return list(self.module_names)
+
+    def infos(self):
+        return [self[module] for module in self.names()]
+
+    def lib_dirs(self):
+        return [os.path.join(self.modules_dir, module) for module in self.names()]
+
+    def newest_version_dirs(self, modules=None):
+        """The newest version folders of the named modules (or all of them) that have one"""
+        infos = (
+            self.infos() if modules is None else [self[module] for module in modules]
         )
-        details[key] = result.stdout.strip()
-    return details
-
+        return [info.newest_version_dir for info in infos if info.newest_version_dir]
 
-def detect_changed_sources(boost_source_dirs):
-    changed_sources = []
+    def source_dirs(self):
+        return [info.source_dir for info in self.infos() if info.source_dir]
 
-    for source in boost_source_dirs:
-        # Check the status to see if there are any changes that aren't staged
-        result = subprocess.run(
-            ["git", "status", "--porcelain"],
-            cwd=source,
-            stdout=subprocess.PIPE,
-            text=True,
+    def module_of(self, path):
+        """Get the name of the module a path inside the modules folder belongs to, or None"""
+        relative_path = os.path.relpath(
+            os.path.abspath(path), os.path.abspath(self.modules_dir)
         )
+        module = relative_path.split(os.sep)[0]
+        return module if module in self else None
 
-        unstaged_changes = []
-        for line in result.stdout.splitlines():
-            status_code = line[:2]
+    def invalidate(self, module):
+        """Forget what was read about a module, e.g. after a version bump or a source.json change"""
+        with self.lock:
+            self.modules.pop(module, None)
 
-            if status_code != "A " and not (
-                status_code == "M " and line.endswith(".gitignore")
-            ):
-                file_path = line[3:]
-                unstaged_changes.append(file_path)
 
-        if unstaged_changes:
-            changed_sources.append(source)
+class RegistryState:
+    """
+    How far each module has got through setup and patching, kept in the registry's .git folder.
 
-    return changed_sources
+    Per module this records the archive integrity (or the name of the Boost release archive it was
+    taken from), whether it was extracted, the baseline commit, whether its patch was applied, the
+    last generated patch's integrity, and the version folder and source.json mtime all of that was
+    based on. If either of those inputs change, the module's
+    record is forgotten so it gets set up again.
+    """
 
+    file_name = "super_tool_state.json"
 
-def bump_modules(registry_dir, base_git_commit_hash, updated_sources):
-    awaiting_bump = []
-    updated_modules = [
-        os.path.join(registry_dir, os.path.basename(source))
-        for source in updated_sources
-    ]
+    def __init__(self, registry_dir):
+        self.path = os.path.join(registry_dir, ".git", self.file_name)
+        self.lock = threading.Lock()
 
-    for module_dir in updated_modules:
-        folders = []
+        try:
+            with open(self.path, "r") as f:
+                self.modules = json.load(f).get("modules", {})
+        except (IOError, json.JSONDecodeError):
+            self.modules = {}
+
+    def get(self, boost_lib_version):
+        """Get a copy of the module's record, forgetting it first if its inputs have changed"""
+        module = os.path.basename(os.path.dirname(boost_lib_version))
+        inputs = {
+            "version": os.path.basename(boost_lib_version),
+            "source_json_mtime": os.stat(
+                os.path.join(boost_lib_version, module_source_file_name)
+            ).st_mtime_ns,
+        }
 
-        result = subprocess.run(
-            [
-                "git",
-                "ls-tree",
-                base_git_commit_hash,
-                module_dir + os.sep,
-            ],
-            cwd=registry_dir,
-            stdout=subprocess.PIPE,
-            text=True,
+        with self.lock:
+            record = self.modules.get(module, {})
+            if any(record.get(key) != value for key, value in inputs.items()):
+                record = self.modules[module] = inputs
+            return dict(record)
+
+    def update(self, boost_lib_version, **fields):
+        """Add fields to the module's record and save it"""
+        module = os.path.basename(os.path.dirname(boost_lib_version))
+        with self.lock:
+            self.modules.setdefault(module, {}).update(fields)
+            self.save()
+
+    def carry_over(self, boost_lib_version, new_boost_lib_version):
+        """
+        Move a module's record to a new version folder made from the same archive, e.g. by a module
+        bump, so its source isn't set up again
+        """
+        record = self.get(boost_lib_version)
+        record.update(
+            version=os.path.basename(new_boost_lib_version),
+            source_json_mtime=os.stat(
+                os.path.join(new_boost_lib_version, module_source_file_name)
+            ).st_mtime_ns,
+        )
+        module = os.path.basename(os.path.dirname(boost_lib_version))
+        with self.lock:
+            self.modules[module] = record
+            self.save()
+
+    def forget(self, module):
+        """Drop everything recorded about a module, e.g. once its sources are deleted"""
+        with self.lock:
+            if self.modules.pop(module, None) is not None:
+                self.save()
+
+    def is_set_up(self, boost_lib_version):
+        """Check whether a version folder's source was fully set up from its current inputs"""
+        record = self.get(boost_lib_version)
+        if not all(record.get(key) for key in ["archive", "baseline", "patched"]):
+            return False
+
+        # Make sure nobody has deleted it from under us
+        return os.path.isdir(
+            os.path.join(
+                os.path.dirname(boost_lib_version), record.get("source_dir", ""), ".git"
+            )
         )
 
-        for line in result.stdout.splitlines():
-            parts = line.split()
-            if len(parts) > 1 and parts[1] == "tree":  # 'tree' indicates a folder
-                folder_name = parts[3]
-                folders.append(os.path.join(registry_dir, folder_name))
+    def save(self):
+        """Write the records to disk atomically. Callers must hold self.lock"""
+        if not os.path.isdir(os.path.dirname(self.path)):
+            return  # Not a git checkout, so nowhere to keep it
 
-        if len(folders) != 0 and (
-            find_newest_version_from_paths(folders)
-            not in find_boost_lib_newest_dirs(module_dir)
-        ):
-            awaiting_bump.append(module_dir)
+        write_json_atomically(self.path, {"modules": self.modules})
 
-    results_array = None
-    if awaiting_bump:
-        # Display confirmation dialogue
-        results_array = checkboxlist_dialog(
-            title="Bump Modules",
-            text="These modules need a version bump! Please select which modules you'd like to bump:",
-            values=awaiting_bump,
-            style=get_custom_style(),
-        ).run()
 
-    patched_sources = []
-    if results_array:
-        # TODO bump modules
-        # awaiting_bump = [
-        #     ("eggs", "Eggs"),
-        #     ("bacon", "Bacon"),
-        #     ("croissants", "20 Croissants"),
-        #     ("daily", "The breakfast of the day"),
-        # ]
-        patched_sources = [
-            updated_sources.substring(source) for source in results_array
-        ]
-        patch_and_hash(registry_dir, patched_sources)
+class HeaderIndex:
+    """
+    Which module provides each Boost header, e.g. boost/numeric/interval.hpp -> boost.interval.
 
-    return patched_sources
+    The headers are kept sorted in a binary file in the registry's .git folder, which is memory
+    mapped and binary searched rather than read in, so loading it is instant whatever its size. Call
+    refresh to bring it up to date with the extracted sources. Only modules whose include folders
+    have had files added, removed or renamed since the last refresh are scanned again.
+    """
 
+    file_name = "super_tool_header_index.bin"
+    magic = b"STHIDX01"
+    # Module count, header count, module table size and path block size
+    header = struct.Struct("<4I")
 
-def patch_and_hash(registry_dir, lib_sources):
-    patch_file_name = "patch.diff"
+    def __init__(self, registry_dir, registry_index):
+        self.registry_index = registry_index
+        self.path = os.path.join(registry_dir, ".git", self.file_name)
+        self.lock = threading.Lock()
+        self.data = self.offsets = self.module_ids = None
+        self.load()
 
-    def task(lib_source, registry_dir):
-        module_dir = os.path.join(
-            registry_dir, os.path.dirname(os.path.dirname(lib_source))
-        )
-        newest_version = find_boost_lib_newest_dirs([module_dir])[0]
-        patches_folder = os.path.join(
-            newest_version,
-            "patches",
+    def load(self):
+        """Map the index file, or start empty if there isn't a valid one"""
+        try:
+            with open(self.path, "rb") as f:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            data = None  # Missing or empty
+        self.set_data(data)
+
+    def set_data(self, data):
+        """Use an index laid out as written by save, from a mmap or bytes"""
+        self.close()
+        self.data = data
+        self.modules = []  # {"name", "fingerprint"} per module, ordered by module id
+        self.count = 0
+        self.offsets = self.module_ids = None
+        if data is None or data[: len(self.magic)] != self.magic:
+            return
+
+        _, count, table_size, paths_size = self.header.unpack_from(
+            data, len(self.magic)
         )
-        diff_file = os.path.join(patches_folder, patch_file_name)
+        position = len(self.magic) + self.header.size
+        self.modules = json.loads(bytes(data[position : position + table_size]))
+        position += table_size
+        view = memoryview(data)
+        self.offsets = view[position : position + 4 * count].cast("I")
+        position += 4 * count
+        self.module_ids = view[position : position + 2 * count].cast("H")
+        self.paths = (position + 2 * count, position + 2 * count + paths_size)
+        self.count = count
+
+    def close(self):
+        """Let go of the mapped file"""
+        if self.offsets is not None:
+            self.offsets.release()
+            self.module_ids.release()
+            self.offsets = self.module_ids = None
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+        self.data = None
+
+    def path_at(self, position):
+        start = self.offsets[position]
+        return self.data[start : self.data.find(b"\0", start)]
+
+    def module_at(self, position):
+        return self.modules[self.module_ids[position]]["name"]
+
+    def lower_bound(self, key):
+        """Find the position of the first header that sorts at or after key"""
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self.path_at(middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def owner(self, header):
+        """Get the module that provides a header such as "boost/config.hpp", or None"""
+        key = header.encode("utf-8", "surrogateescape")
+        position = self.lower_bound(key)
+        if position < self.count and self.path_at(position) == key:
+            return self.module_at(position)
+        return None
 
-        subprocess.run(
-            ["git", "add", "."],
-            cwd=lib_source,
+    def find(self, prefix):
+        """
+        Get a (header, module) pair for every header starting with prefix, such as
+        "boost/numeric/interval/", in sorted order.
+        """
+        key = prefix.encode("utf-8", "surrogateescape")
+        results = []
+        for position in range(self.lower_bound(key), self.count):
+            path = self.path_at(position)
+            if not path.startswith(key):
+                break
+            results.append(
+                (path.decode("utf-8", "surrogateescape"), self.module_at(position))
+            )
+        return results
+
+    def refresh(self):
+        """
+        Scan the include folders of any modules that changed since the index was built, and save it.
+
+        :return: True if anything changed.
+        """
+        with self.lock:
+            fingerprints = {}
+            for module in self.registry_index.names():
+                source = self.registry_index[module].source_dir
+                if source and os.path.isdir(source):
+                    fingerprints[module] = tree_fingerprint(
+                        os.path.join(source, "include")
+                    )
+
+            known = {module["name"]: module["fingerprint"] for module in self.modules}
+            if known == fingerprints:
+                return False
+
+            # Keep what's still right, and scan the rest again
+            entries = []
+            if self.count:
+                paths_start, paths_end = self.paths
+                paths = bytes(self.data[paths_start:paths_end]).split(b"\0")
+                entries = [
+                    (path, self.module_at(position))
+                    for position, path in enumerate(paths[:-1])
+                    if known[self.module_at(position)]
+                    == fingerprints.get(self.module_at(position))
+                ]
+
+            changed = [
+                module
+                for module, fingerprint in fingerprints.items()
+                if known.get(module) != fingerprint
+            ]
+            results = run_multithreaded_tasks(
+                [self.registry_index[module].source_dir for module in changed],
+                list_headers,
+                None,
+                "Indexing headers",
+            )
+            for module, result in zip(changed, results):
+                if result.error:
+                    fingerprints.pop(module)  # So it's scanned again next time
+                else:
+                    entries += [(path, module) for path in result.result]
+
+            self.save(entries, fingerprints)
+            return True
+
+    def save(self, entries, fingerprints):
+        """Write (header path bytes, module) entries out as the index, and use it"""
+        entries.sort()
+        names = sorted(fingerprints)
+        module_ids = {name: index for index, name in enumerate(names)}
+
+        table = json.dumps(
+            [{"name": name, "fingerprint": fingerprints[name]} for name in names]
+        ).encode()
+        table += b" " * (-len(table) % 4)  # Keep the arrays after it aligned
+        paths_start = len(self.magic) + self.header.size + len(table) + 6 * len(entries)
+        offsets = array.array("I")
+        for path, _ in entries:
+            offsets.append(paths_start)
+            paths_start += len(path) + 1
+        paths = b"".join(path + b"\0" for path, _ in entries)
+
+        data = b"".join(
+            [
+                self.magic,
+                self.header.pack(len(names), len(entries), len(table), len(paths)),
+                table,
+                offsets.tobytes(),
+                array.array(
+                    "H", (module_ids[module] for _, module in entries)
+                ).tobytes(),
+                paths,
+            ]
         )
 
-        # Create and write the git diff
-        diff = subprocess.check_output(
-            ["git", "diff", "--cached"],
-            cwd=lib_source,
+        if not os.path.isdir(os.path.dirname(self.path)):
+            self.set_data(data)  # Not a git checkout, so keep it in memory
+            return
+        self.close()
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "wb") as f:
+            f.write(data)
+        os.replace(temp_path, self.path)
+        self.load()
+
+
+def list_headers(source):
+    """List the header paths a source provides relative to its include folder, as bytes"""
+    include_dir = os.path.join(os.fsencode(source), b"include")
+    headers = []
+    for dir_path, _, file_names in os.walk(include_dir):
+        relative_dir = os.path.relpath(dir_path, include_dir).replace(
+            os.sep.encode(), b"/"
         )
-        with open(diff_file, "wb") as f:
-            f.write(diff)
+        prefix = b"" if relative_dir == b"." else relative_dir + b"/"
+        headers += [prefix + name for name in file_names]
+    return headers
 
-        # Calculate SHA256 hash of 'patch.diff' and encode in base64
-        integrity_result = subprocess.run(
-            f"openssl dgst -sha256 -binary '{diff_file}' | openssl base64 -A",
-            shell=True,
-            capture_output=True,
-            text=True,
-        )
-        integrity = "sha256-" + integrity_result.stdout.strip()
 
-        # Update module_source_file_name with the new patch information
-        source_json_path = os.path.join(
-            os.path.dirname(patches_folder), module_source_file_name
+def tree_fingerprint(path):
+    """
+    Digest the path and mtime of every folder under path. Adding, removing or renaming a file changes
+    it, but editing one doesn't.
+    """
+    hasher = hashlib.blake2b(digest_size=16)
+    for dir_path, dir_names, _ in os.walk(path):
+        dir_names.sort()
+        hasher.update(
+            f"{dir_path}\0{os.stat(dir_path).st_mtime_ns}\n".encode(
+                "utf-8", "surrogateescape"
+            )
         )
+    return hasher.hexdigest()
 
-        with open(source_json_path, "r") as f:
-            data = json.load(f)
 
-        data["patches"] = {patch_file_name: integrity}
+class DependencyGraph:
+    """
+    Which modules each module depends on, and is depended on by, from the bazel_deps in its newest
+    version's MODULE.bazel. Dev dependencies are left out as they don't affect dependents.
 
-        with open(source_json_path, "w") as f:
-            json.dump(data, f, indent=2)
+    The bazel_deps read are cached in the registry's .git folder, and only read again for modules
+    whose MODULE.bazel has changed.
+    """
 
-        # Copy the MODULE.bazel file to the version folder
-        src = os.path.join(lib_source, "MODULE.bazel")
-        dst = os.path.join(newest_version, os.path.basename(src))
-        shutil.copy(src, dst)
+    file_name = "super_tool_dependency_graph.json"
 
-    run_multithreaded_tasks(
-        lib_sources,
-        task,
-        4,
-        "Patching",
-        registry_dir,
-    )
+    def __init__(self, registry_dir, registry_index):
+        self.path = os.path.join(registry_dir, ".git", self.file_name)
+        try:
+            with open(self.path, "r") as f:
+                cached = json.load(f)["modules"]
+        except (IOError, json.JSONDecodeError, KeyError):
+            cached = {}
+
+        records = {}
+        for module in registry_index.names():
+            newest_version_dir = registry_index[module].newest_version_dir
+            if not newest_version_dir:
+                continue
+            module_bazel = os.path.join(newest_version_dir, "MODULE.bazel")
+            try:
+                stat = os.stat(module_bazel)
+            except FileNotFoundError:
+                continue
+            key = [os.path.basename(newest_version_dir), stat.st_mtime_ns, stat.st_size]
+
+            record = cached.get(module)
+            if not record or record.get("key") != key:
+                record = {"key": key, "deps": read_bazel_deps(module_bazel)}
+            records[module] = record
+
+        if records != cached and os.path.isdir(os.path.dirname(self.path)):
+            write_json_atomically(self.path, {"modules": records})
+
+        self.dependencies = {
+            module: sorted(
+                {
+                    dependency
+                    for dependency in records.get(module, {}).get("deps", [])
+                    if dependency in registry_index and dependency != module
+                }
+            )
+            for module in registry_index.names()
+        }
+        self.dependents = {module: [] for module in self.dependencies}
+        for module, dependencies in self.dependencies.items():
+            for dependency in dependencies:
+                self.dependents[dependency].append(module)
+
+    def transitive_dependents(self, modules):
+        """Get the modules given plus every module depending on them, directly or not, as a set"""
+        found = set(modules)
+        pending = list(found)
+        while pending:
+            for dependent in self.dependents.get(pending.pop(), []):
+                if dependent not in found:
+                    found.add(dependent)
+                    pending.append(dependent)
+        return found
+
+    def topological_levels(self, modules):
+        """
+        Put modules in dependency order, as a list of levels (sorted lists of module names). Each
+        module's dependencies among the given modules are all in earlier levels, so the modules
+        within a level can be processed in parallel. Modules in a dependency cycle share a last level.
+        """
+        modules = set(modules)
+        remaining = {
+            module: len(modules.intersection(self.dependencies.get(module, [])))
+            for module in modules
+        }
+        levels = []
+        level = sorted(module for module, count in remaining.items() if count == 0)
+        while level:
+            levels.append(level)
+            next_level = []
+            for module in level:
+                del remaining[module]
+                for dependent in self.dependents.get(module, []):
+                    if dependent in remaining:
+                        remaining[dependent] -= 1
+                        if remaining[dependent] == 0:
+                            next_level.append(dependent)
+            level = sorted(next_level)
+
+        if remaining:
+            logging.warning(
+                f"Dependency cycle between {', '.join(sorted(remaining))}, processing them together"
+            )
+            levels.append(sorted(remaining))
+        return levels
 
 
-def tidy_up(boost_lib_dirs):
-    # TODO Ensure everything is patch created etc, warn and stop if changes will be lost
+def read_bazel_deps(module_bazel_path):
+    """Get the names of the modules a MODULE.bazel has a bazel_dep on, ignoring dev dependencies"""
+    with open(module_bazel_path, "r") as f:
+        text = f.read()
 
-    with ProgressBar() as pb:
-        for lib in pb(boost_lib_dirs):
-            diffed_sources_dir = os.path.join(lib, "diffed_sources")
-            pb.title = HTML(f"<ansiblue>Removing {diffed_sources_dir}</ansiblue>")
-            if os.path.exists(diffed_sources_dir):
-                shutil.rmtree(diffed_sources_dir)
+    dependencies = []
+    for match in re.finditer(r"^bazel_dep\(([^)]*)\)", text, re.MULTILINE):
+        name = re.search(r'name = "([^"]+)"', match.group(1))
+        if name and not re.search(r"dev_dependency = True", match.group(1)):
+            dependencies.append(name.group(1))
+    return dependencies
 
 
 def find_boost_lib_dirs(modules_dir):
@@ -666,144 +4519,204 @@ def find_boost_lib_dirs(modules_dir):
     return boost_lib_dirs
 
 
-def find_boost_source_dirs(boost_lib_newest_version_dirs):
-    boost_source_dirs = []
-
-    for lib_version in boost_lib_newest_version_dirs:
-        try:
-            # Open module_source_file_name and get the strip_prefix value
-            with open(
-                os.path.join(lib_version, module_source_file_name), "r"
-            ) as source_json_file:
-                source_json = json.load(source_json_file)
-                strip_prefix = source_json.get("strip_prefix", "")
-
-            # Construct and add the source directory path
-            boost_source_dirs.append(
-                os.path.join(
-                    os.path.dirname(lib_version), "diffed_sources", strip_prefix
-                )
-            )
-
-        except (IOError, json.JSONDecodeError) as e:
-            logging.error(
-                f"Error reading {module_source_file_name} for {lib_version}: {e}"
-            )
-
-    return boost_source_dirs
+def version_key(version):
+    """Sort key for version folder names, e.g. 1.83.0 or 1.83.0.bcr.1"""
+    return tuple(int(part) for part in version.split(".") if part.isdigit())
 
 
-def find_boost_lib_newest_dirs(boost_lib_dirs):
-    boost_libs_newest_dirs = []
+TaskResult = namedtuple("TaskResult", ["item", "result", "error"])
 
-    for lib in boost_lib_dirs:
-        newest = find_newest_version_from_paths(
-            [os.path.join(lib, path) for path in os.listdir(lib)]
-        )
-        if newest:
-            boost_libs_newest_dirs.append(newest)
-
-    return boost_libs_newest_dirs
 
+def run_multithreaded_tasks(
+    items, worker_func, num_threads=None, task_name="Processing", *args, **kwargs
+):
+    """
+    Run tasks across multiple threads with a progress bar.
 
-def find_newest_version_from_paths(paths):
-    found_versions = []
+    The progress bar moves as each task completes, and an exception in one task is logged and
+    returned rather than stopping the others. Ctrl-C cancels every task that hasn't started yet.
 
-    # Find all directories starting with "1."
-    for version in paths:
-        if os.path.isdir(version) and os.path.basename(version).startswith("1."):
-            found_versions.append(version)
+    :param items: A list of items to process.
+    :param worker_func: The function to process each item. It should take one iterable argument. Extra args from this function will be passed to the worker.
+    :param num_threads: Number of threads to use. Defaults to one per core, and is never more than the number of items.
+    :param task_name: Name of the task for display purposes.
+    :param args: Additional positional arguments to pass to worker_func.
+    :param kwargs: Additional keyword arguments to pass to worker_func.
+    :return: A TaskResult(item, result, error) per item, in the same order as items. error is the exception the task raised, or None.
+    """
+    items = list(items)
+    results = [None] * len(items)
+    if not items:
+        return results
 
-    # Sort the directories based on the versioning scheme
-    found_versions.sort(
-        key=lambda x: tuple(
-            int(part) for part in os.path.basename(x).split(".") if part.isdigit()
-        )
+    executor = ThreadPoolExecutor(
+        max_workers=min(num_threads or local_threads, len(items))
     )
+    worker_func = tracer.propagate(worker_func)
+    try:
+        futures = {
+            executor.submit(worker_func, item, *args, **kwargs): index
+            for index, item in enumerate(items)
+        }
 
-    # The newest directory is the last in the sorted list
-    newest_version = found_versions[-1] if found_versions else None
-
-    if newest_version:
-        return newest_version
-    else:
-        logging.error(f"No newest found. Directories were: {found_versions}")
-        return None
-
-
-def find_matching_path(paths, substring):
-    """Use list comprehension to filter paths containing the substring"""
-    matching_paths = [path for path in paths if substring in path]
+        # Update the progress bar from the main thread as each task completes
+        with progress_bar() as pb:
+            for future in pb(as_completed(futures), total=len(items)):
+                index = futures[future]
+                pb.title = progress_title(f"{task_name} {items[index]}")
+                try:
+                    results[index] = TaskResult(items[index], future.result(), None)
+                except Exception as e:
+                    logging.error(f"{task_name} {items[index]} failed: {e}")
+                    results[index] = TaskResult(items[index], None, e)
 
-    if len(matching_paths) > 1:
-        logging.error(f"Multiple paths containing {substring} found: {matching_paths}")
+    finally:
+        # Only does anything if we're leaving early, e.g. on Ctrl-C
+        executor.shutdown(cancel_futures=True)
 
-    # Return the matching path or None if there are no matches
-    return matching_paths[0] if matching_paths else None
+    return results
 
 
-def run_multithreaded_tasks(
-    items, worker_func, num_threads=4, task_name="Processing", *args, **kwargs
-):
+def run_pipeline(items, stages, task_name="Processing"):
     """
-    Run tasks across multiple threads with a progress bar.
+    Run every item through a sequence of stages, showing a progress bar per stage.
+
+    Each stage has its own thread pool, and an item is queued for the next stage as soon as it
+    leaves the previous one, so one slow item never holds up the rest and every stage is kept busy.
 
     :param items: A list of items to process.
-    :param worker_func: The function to process each item. It should take one iterable argument. Extra args from this function will be passed to the worker.
-    :param num_threads: Number of threads to use.
+    :param stages: A list of (stage name, function, number of threads) tuples. Each function is
+        called with an item, and can return False to take that item out of the remaining stages.
+        A stage can have a fourth element, a function returning more to show in its label such as
+        the bytes downloaded so far. Labels are refreshed every progress_refresh_interval.
     :param task_name: Name of the task for display purposes.
-    :param args: Additional positional arguments to pass to worker_func.
-    :param kwargs: Additional keyword arguments to pass to worker_func.
+    :return: A list of (item, stage name, exception) for every item a stage raised an exception on.
     """
-    # Shared variables for progress tracking
-    progress_lock = threading.Lock()
-    completed_tasks = 0
-    total_tasks = len(items)
-    current_item = [None]  # Using a list to make it mutable
-    items_queue = Queue()
-
-    # Load the queue with items
-    for item in items:
-        items_queue.put(item)
-
-    def thread_worker():
-        nonlocal completed_tasks
-        while not items_queue.empty():
-            item = items_queue.get()
-            worker_func(
-                item, *args, **kwargs
-            )  # Pass additional arguments to worker_func
-            with progress_lock:
-                completed_tasks += 1
-                current_item[0] = str(item)
-            items_queue.task_done()
-
-    # Creating and starting threads
-    threads = []
-    for _ in range(num_threads):
-        thread = threading.Thread(target=thread_worker)
-        thread.start()
-        threads.append(thread)
-
-    # Updating the progress bar in the main thread
-    with ProgressBar() as pb:
-        for _ in pb(range(total_tasks)):
-            while True:
-                with progress_lock:
-                    if completed_tasks > 0:
-                        pb.title = HTML(
-                            f"<ansiblue>{task_name} {current_item[0]}</ansiblue>"
-                        )
-                        completed_tasks -= 1
-                        break
-                time.sleep(0.1)
+    # Workers report here, so only the main thread touches the progress bar
+    events = Queue()
+    executors = [ThreadPoolExecutor(max_workers=stage[2]) for stage in stages]
+    waiting = [0] * len(stages)
+    active = [0] * len(stages)
+    remaining = len(items)
+    failures = []
+
+    @tracer.propagate
+    def run_stage(index, item):
+        events.put(("started", index, item, None))
+        name, func = stages[index][:2]
+        try:
+            carry_on = func(item) is not False
+        except Exception as e:
+            logging.error(f"{name} {item} failed: {e}")
+            failures.append((item, name, e))
+            carry_on = False
+        events.put(("finished", index, item, carry_on))
+
+    def submit(index, item):
+        waiting[index] += 1
+        executors[index].submit(run_stage, index, item)
+
+    try:
+        with progress_bar(title=progress_title(task_name)) as pb:
+            counters = [pb(label=stage[0], total=len(items)) for stage in stages]
+            for item in items:
+                submit(0, item)
+
+            while remaining:
+                try:
+                    event, index, item, carry_on = events.get(
+                        timeout=progress_refresh_interval
+                    )
+                except Empty:
+                    event = None  # Nothing happened, but labels may have more to show
+
+                if event == "started":
+                    waiting[index] -= 1
+                    active[index] += 1
+                elif event == "finished":
+                    active[index] -= 1
+                    counters[index].item_completed()
+                    if carry_on and index + 1 < len(stages):
+                        submit(index + 1, item)
+                    else:
+                        # Finished early or at the end, either way it's done
+                        remaining -= 1
+                        for counter in counters[index + 1 :]:
+                            counter.total -= 1
+
+                # Show how many items are in each stage
+                for counter, stage, stage_waiting, stage_active in zip(
+                    counters, stages, waiting, active
+                ):
+                    details = [f"{stage_active} active", f"{stage_waiting} waiting"]
+                    if len(stage) > 3:
+                        details.append(stage[3]())
+                    counter.label = f"{stage[0]} ({', '.join(details)})"
+                pb.invalidate()
+
+    finally:
+        # Only does anything if we're leaving early, e.g. on Ctrl-C
+        for executor in executors:
+            executor.shutdown(cancel_futures=True)
+
+    return failures
+
+
+def progress_bar(**kwargs):
+    """Make a ProgressBar, or a QuietProgressBar if progress isn't being shown"""
+    if not show_progress:
+        return QuietProgressBar(**kwargs)
+
+    from prompt_toolkit.shortcuts import ProgressBar
+
+    return ProgressBar(**kwargs)
+
+
+def progress_title(text):
+    """Format a progress bar title"""
+    if not show_progress:
+        return text
+
+    from prompt_toolkit.formatted_text import HTML
+
+    return HTML(f"<ansiblue>{text}</ansiblue>")
+
+
+class QuietProgressBar:
+    """Stands in for a ProgressBar, taking the same calls but showing nothing"""
+
+    def __init__(self, title=None, **kwargs):
+        self.title = title
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def __call__(self, data=None, label="", total=None, **kwargs):
+        return QuietProgressCounter(data, label, total)
+
+    def invalidate(self):
+        pass
+
+
+class QuietProgressCounter:
+    def __init__(self, data, label, total):
+        self.data = data
+        self.label = label
+        self.total = total
 
-    # Waiting for all threads to finish
-    for thread in threads:
-        thread.join()
+    def __iter__(self):
+        return iter(self.data if self.data is not None else [])
+
+    def item_completed(self):
+        pass
 
 
 def get_custom_style():
+    from prompt_toolkit.styles import Style
+
     white = "#ffffff"
     black = "#000000"
     bazel_green = "#44a147"
@@ -822,15 +4735,4 @@ def get_custom_style():
 
 
 if __name__ == "__main__":
-    workspace_dir = os.environ.get("BUILD_WORKSPACE_DIRECTORY")
-    if workspace_dir is not None:
-        main(workspace_dir)
-    else:
-        if len(sys.argv) > 2:
-            print(
-                "Usage: python super_tool.py < registry_folder >  < * Optional Shortcuts * >"
-            )
-        else:
-            main(sys.argv[1])
-
-    sys.exit(1)
+    sys.exit(cli(sys.argv[1:]))